@@ -102,7 +102,7 @@ def pre_delete_code(request, lookup):
         code_type = code['meta']['code_type']
     log.debug('code | Delete | code - %s | code_type - %s', code['_id'], code_type)
     site_query = 'where={{"code.{0}":"{1}"}}'.format(code_type, code['_id'])
-    sites = utilities.get_eve('sites', site_query)
+    sites = utilities.get_eve('sites', site_query, projection=['sid'])
     log.debug('code | Delete | code - %s | sites result - %s', code['_id'], sites)
     if not sites['_meta']['total'] == 0:
         site_list = []
@@ -188,7 +188,7 @@ def on_insert_code(items):
         log.debug('code | POST | On Insert callback | %s', item)
         # Check to see if we have a current profile and core.
         code_query = 'where={{"meta.name":"{0}","meta.version":"{1}","meta.code_type":"{2}"}}'.format(item['meta']['name'], item['meta']['version'], item['meta']['code_type'])
-        code = utilities.get_eve('code', code_query)
+        code = utilities.get_eve('code', code_query, projection=['_id'])
         log.debug('code | POST | On Insert callback | Code query result | %s', code)
         if not code['_meta']['total'] == 0:
             log.error('code | POST | On Insert callback | %s named %s-%s already exists', item['meta']['code_type'], item['meta']['name'], item['meta']['version'])
@@ -196,12 +196,12 @@ def on_insert_code(items):
 
         if item.get('meta') and item['meta'].get('is_current') and item['meta']['is_current'] is True:
             query = 'where={{"meta.name":"{0}","meta.code_type":"{1}","meta.is_current": true}}'.format(item['meta']['name'], item['meta']['code_type'])
-            code_get = utilities.get_eve('code', query)
+            code_get = utilities.get_eve('code', query, projection=['_id'])
             log.debug('code | Insert | current code - %s', code_get)
             if code_get['_meta']['total'] != 0:
                 for code in code_get['_items']:
                     request_payload = {'meta.is_current': False}
-                    utilities.patch_eve('code', code['_id'], request_payload)
+                    utilities.patch_eve('code', code['_id'], request_payload, etag=code['_etag'])
         log.debug('code | Insert | Ready to deploy item - %s', item)
         tasks.code_deploy.delay(item)
 
@@ -238,7 +238,7 @@ def on_delete_item_code(item):
     if item['meta']['code_type'] == 'static':
         query = 'where={{"meta.name":"{0}","meta.code_type":"static","_id":{{"$ne":"{1}"}}}}'.format(
             item['meta']['name'], item['_id'])
-        code = utilities.get_eve('code', query)
+        code = utilities.get_eve('code', query, projection=['_id'])
         if code['_meta']['total'] != 0:
             other_static_assets = True
     log.info('code | on delete | other static assets - %s', other_static_assets)
@@ -271,12 +271,12 @@ def on_update_code(updates, original):
 
         query = 'where={{"meta.name":"{0}","meta.code_type":"{1}","meta.is_current": true,"_id":{{"$ne":"{2}"}}}}'.format(
             name, code_type, original['_id'])
-        code_get = utilities.get_eve('code', query)
+        code_get = utilities.get_eve('code', query, projection=['_id'])
         log.debug('code | on update | Current code - %s', code_get)
 
         for code in code_get['_items']:
             request_payload = {'meta.is_current': False}
-            utilities.patch_eve('code', code['_id'], request_payload)
+            utilities.patch_eve('code', code['_id'], request_payload, etag=code['_etag'])
 
     # We need the whole record so that we can manipulate code in the right place.
     # Copy 'original' to a new dict, then update it with values from 'updates' to create an item to
@@ -379,15 +379,127 @@ def on_updated_code(updates, original):
     if update_sites:
         log.info('Code | on updated | Preparing to update instances')
         query = 'where={{"code.{0}":"{1}"}}'.format(code_type, original['_id'])
-        sites_get = utilities.get_eve('sites', query)
+        sites_get = utilities.get_eve('sites', query, projection=['code'])
 
         if sites_get['_meta']['total'] is not 0:
+            patches = []
             for site in sites_get['_items']:
                 log.debug('code | on updated | site - %s', site)
                 code_id_string = site['code'][code_type]
                 payload = {'code': {code_type: code_id_string}}
                 log.debug('code | on updated | payload - %s', payload)
-                utilities.patch_eve('sites', site['_id'], payload)
+                patches.append({'_id': site['_id'], '_etag': site['_etag'], 'updates': payload})
+            utilities.bulk_patch_eve('sites', patches)
+
+
+def code_needs_deploy(updates):
+    """
+    Check if a code update changes what is deployed on the servers.
+
+    :param updates:
+    """
+    if updates.get('meta') and any(key in updates['meta']
+                                   for key in ['name', 'version', 'code_type']):
+        return True
+    return 'commit_hash' in updates or 'git_url' in updates
+
+
+def on_bulk_update_code(updates_list, originals):
+    """
+    Update code on the servers for the items in a bulk update that need it, see `on_update_code`.
+
+    :param updates_list: List of updates for each item
+    :param originals: List of original items
+    """
+    log.debug('code | on bulk update | Count - %s', len(originals))
+    for updates, original in zip(updates_list, originals):
+        if code_needs_deploy(updates) or updates.get('meta', {}).get('is_current') is True:
+            on_update_code(updates, original)
+
+
+def on_bulk_updated_code(updates_list, originals):
+    """
+    Update instances that use code changed in a bulk update, see `on_updated_code`.
+
+    :param updates_list: List of updates for each item
+    :param originals: List of original items
+    """
+    log.debug('code | on bulk updated | Count - %s', len(originals))
+    for updates, original in zip(updates_list, originals):
+        if code_needs_deploy(updates):
+            on_updated_code(updates, original)
+
+
+def on_bulk_update_sites(updates_list, originals):
+    """
+    Update instances in a bulk update, see `on_update_sites`.
+
+    Only changes to code, status, or settings require work on the servers, so updates that only
+    touch metadata (like `update_group`) don't queue a task at all.
+
+    :param updates_list: List of updates for each item
+    :param originals: List of original items
+    """
+    log.debug('sites | on bulk update | Count - %s', len(originals))
+    for updates, original in zip(updates_list, originals):
+        if updates.get('code') or updates.get('status') or updates.get('settings'):
+            on_update_sites(updates, original)
+
+
+def on_bulk_delete_sites(items):
+    """
+    Make sure none of the instances in a bulk delete are launched, see `pre_delete_sites`.
+
+    :param items: List of instances to be deleted
+    """
+    launched = [str(item['_id']) for item in items if item['status'] in ['launched', 'launching']]
+    if launched:
+        log.error('Instances | Bulk Delete | Instances are launched or launching - %s', launched)
+        abort(409, 'One or more instances are launched or launching. To delete, take instances '
+                   'down first.')
+
+
+def on_bulk_deleted_sites(items):
+    """
+    Remove instances from the servers after a bulk delete and send a single Slack notification.
+
+    :param items: List of deleted instances
+    """
+    if not items:
+        return
+    tasks.site_remove_batch.delay(items)
+
+    slack_text = 'Site Remove - Success - {0} instances'.format(len(items))
+    slack_payload = {
+        "text": slack_text,
+        "attachments": [
+            {
+                "fallback": slack_text,
+                "color": 'good',
+                "fields": [
+                    {"title": "Instances",
+                     "value": ', '.join('{0}/{1}'.format(BASE_URLS[ENVIRONMENT], item['path'])
+                                        for item in items),
+                     "short": False},
+                    {"title": "Environment", "value": ENVIRONMENT, "short": True},
+                    {"title": "Delete requested by", "value": items[0].get('modified_by'),
+                     "short": True}
+                ],
+            }
+        ],
+    }
+    utilities.post_to_slack_payload(slack_payload)
+
+
+def on_bulk_deleted_backup(items):
+    """
+    Remove the files for all backups in a bulk delete with a single task.
+
+    :param items: List of deleted backups
+    """
+    log.debug('Backup | on bulk deleted | Count - %s', len(items))
+    if items:
+        tasks.backup_remove_batch.delay(items)
 
 
 # Update user fields on all events. If the update is coming from Drupal, it
@@ -440,6 +552,22 @@ def on_delete_item(resource, item):
         item['modified_by'] = username
 
 
+def on_bulk_update(resource, updates_list, originals):
+    """
+    On bulk PATCH, add the username to each item, see `pre_update`.
+    """
+    for updates, original in zip(updates_list, originals):
+        pre_update(resource, updates, original)
+
+
+def on_bulk_delete(resource, items):
+    """
+    On bulk DELETE, add the username to each item, see `on_delete_item`.
+    """
+    for item in items:
+        on_delete_item(resource, item)
+
+
 def on_deleted_item_sites(item):
     """
     After the DELETE, notify slack
@@ -3,23 +3,92 @@
     ~~~~
     Commands that run on servers to deploy code.
 """
+import errno
+import fcntl
+import hashlib
+import json
 import logging
 import os
+import re
 import shutil
+import stat
 import subprocess
+import threading
+import time
 import git
 
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
 from atlas import utilities
-from atlas.config import (ENVIRONMENT, CODE_ROOT, WEB_ROOT)
-from atlas.config_servers import (SERVERDEFS)
+from atlas import sync_operations
+from atlas.config import (CODE_ROOT, WEB_ROOT, CODE_MIRROR_ROOT, CODE_HEAL_MAX_WORKERS,
+                          CODE_HEAL_PER_GIT_HOST, CODE_STORE_ROOT)
 
 # Setup a sub-logger. See tasks.py for longer comment.
 log = logging.getLogger('atlas.code_operations')
 
+# Full or abbreviated commit hash. Anything else, like a branch name, can move and is always
+# fetched.
+COMMIT_HASH_REGEX = re.compile(r'^[0-9a-f]{7,40}$')
+# Store keys for the files in a checkout, see `store_version`.
+STORE_MANIFEST = '.git/atlas_manifest.json'
+
+
+def mirror_path(git_url):
+    """Determine the path for the bare mirror of a repository
+
+    Arguments:
+        git_url {string} -- URL of the repository
+
+    Returns:
+        string -- path inside CODE_MIRROR_ROOT
+    """
+    return '{0}/{1}.git'.format(CODE_MIRROR_ROOT, hashlib.sha1(git_url).hexdigest())
+
+
+def repository_mirror(git_url):
+    """Create or update the bare mirror of a repository
+
+    Only one process updates a mirror at a time.
+
+    Arguments:
+        git_url {string} -- URL of the repository
+
+    Returns:
+        string -- path to the mirror
+    """
+    path = mirror_path(git_url)
+    if not os.path.isdir(CODE_MIRROR_ROOT):
+        try:
+            os.makedirs(CODE_MIRROR_ROOT)
+        except OSError:
+            # Another process created it.
+            pass
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.isdir(path):
+                log.info('Code | Mirror | Fetch | URL - %s', git_url)
+                git.Repo(path).remote().fetch(prune=True)
+            else:
+                log.info('Code | Mirror | Clone | URL - %s | Path - %s', git_url, path)
+                try:
+                    git.Repo.clone_from(git_url, path, mirror=True)
+                except Exception:
+                    # Don't leave a partial mirror for the next clone to fetch into.
+                    shutil.rmtree(path, ignore_errors=True)
+                    raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return path
+
 
 def repository_clone(item):
     """
-    Clone code to the local server.
+    Clone code to the local server. When CODE_MIRROR_ROOT is set, objects are copied from the
+    mirror for the repository and only missing objects are fetched. The clone does not depend on
+    the mirror afterwards, so it can be synced on its own.
 
     :param item:
     :return:
@@ -31,7 +100,18 @@ def repository_clone(item):
     if os.path.exists(code_dir):
         raise Exception('Destinaton directory already exists')
     os.makedirs(code_dir)
-    clone = git.Repo.clone_from(item['git_url'], code_dir)
+    reference = None
+    if CODE_MIRROR_ROOT:
+        try:
+            reference = repository_mirror(item['git_url'])
+        except Exception as error:
+            log.error('Code | Mirror | Failed, cloning without it | URL - %s | Error - %s',
+                      item['git_url'], error)
+    if reference:
+        clone = git.Repo.clone_from(item['git_url'], code_dir, reference=reference,
+                                    dissociate=True)
+    else:
+        clone = git.Repo.clone_from(item['git_url'], code_dir)
     log.info('Code | Clone | Result - %s', clone)
 
 
@@ -44,12 +124,49 @@ def repository_checkout(item):
     """
     log.info('Code | Checkout | Hash - %s', item['commit_hash'])
     log.debug('Code | Checkout | Item - %s', item)
-    # Inializa and fetch repo
+    # Inialize repo, only fetch if we don't have the commit yet.
     repo = git.Repo(utilities.code_path(item))
-    repo.remote().fetch()
+    commit = local_commit(repo, item['commit_hash'])
+    if commit is None:
+        log.info('Code | Checkout | Fetch | Hash - %s', item['commit_hash'])
+        repo.remote().fetch()
+        commit = repo.commit(item['commit_hash'])
     # Point HEAD to the correct commit and reset
-    repo.head.reference = repo.commit(item['commit_hash'])
+    repo.head.reference = commit
     repo.head.reset(index=True, working_tree=True)
+    # Git replaces files instead of writing to them, so a checkout never changes the store. Files it
+    # wrote are linked into the store again.
+    if CODE_STORE_ROOT:
+        store_version(item)
+
+
+def local_commit(repo, commit_hash):
+    """Find a commit in a repository without fetching
+
+    Arguments:
+        repo {git.Repo} -- repository to look in
+        commit_hash {string} -- hash to find
+
+    Returns:
+        git.Commit -- the commit, or None if it needs to be fetched
+    """
+    if not COMMIT_HASH_REGEX.match(commit_hash):
+        return None
+    try:
+        # HEAD usually matches already, like during a heal.
+        commit = repo.head.commit
+        if commit.hexsha.startswith(commit_hash):
+            return commit
+    except ValueError:
+        # Nothing is checked out.
+        pass
+    try:
+        commit = repo.commit(commit_hash)
+    except (ValueError, git.BadName, git.BadObject, git.GitCommandError):
+        return None
+    if commit.hexsha.startswith(commit_hash):
+        return commit
+    return None
 
 
 def repository_remove(item):
@@ -62,16 +179,147 @@ def repository_remove(item):
     log.info('Code | Remove | Item - %s', item['_id'])
     log.debug('Code | Remove | Item - %s', item)
     shutil.rmtree(utilities.code_path(item))
+    if CODE_STORE_ROOT:
+        prune_store()
 
 
-def update_symlink_current(item):
+def file_digest(path):
+    """Hash the content of a file for the store
     """
-    Determine the path for a code item
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_version(item):
+    """Replace the files in a checkout with hardlinks to the same content in CODE_STORE_ROOT
+
+    Files are keyed on a hash of their content and whether they are executable. Content that is not
+    in the store yet is added by linking the file into it. A manifest of the path and key of each
+    file is written to the `.git` directory of the checkout.
+
+    Arguments:
+        item {dict} -- code item
+
+    Returns:
+        dict -- 'files' in the manifest, 'linked' files that now share a copy in the store, and
+        'added' list of store paths that are new
+    """
+    code_dir = utilities.code_path(item)
+    manifest = {}
+    result = {'files': 0, 'linked': 0, 'added': []}
+    for root, directories, files in os.walk(code_dir):
+        if root == code_dir and '.git' in directories:
+            directories.remove('.git')
+        for filename in files:
+            path = os.path.join(root, filename)
+            file_stats = os.lstat(path)
+            if not stat.S_ISREG(file_stats.st_mode):
+                continue
+            key = file_digest(path)
+            if file_stats.st_mode & stat.S_IXUSR:
+                key += 'x'
+            manifest[os.path.relpath(path, code_dir)] = key
+            store_path = store_key_path(key)
+            try:
+                store_stats = os.stat(store_path)
+            except OSError:
+                store_stats = None
+            if store_stats is None:
+                if not os.path.isdir(os.path.dirname(store_path)):
+                    try:
+                        os.makedirs(os.path.dirname(store_path))
+                    except OSError:
+                        # Another process created it.
+                        pass
+                try:
+                    os.link(path, store_path)
+                    result['added'].append(store_path)
+                    continue
+                except OSError as error:
+                    if error.errno != errno.EEXIST:
+                        raise
+                    # Another version added the same content first, link to that.
+                    store_stats = os.stat(store_path)
+            if (store_stats.st_dev, store_stats.st_ino) != (file_stats.st_dev, file_stats.st_ino):
+                link_path = path + '.atlas-link'
+                try:
+                    os.link(store_path, link_path)
+                except OSError as error:
+                    if error.errno != errno.ENOENT:
+                        raise
+                    # Pruned since we looked, keep this copy.
+                    continue
+                os.rename(link_path, path)
+                result['linked'] += 1
+    result['files'] = len(manifest)
+    with open(code_dir + '/' + STORE_MANIFEST, 'w') as f:
+        json.dump(manifest, f)
+    log.info('Code | Store | Item - %s | Files - %s | Linked - %s | Added - %s', item['_id'],
+             result['files'], result['linked'], len(result['added']))
+    return result
+
+
+def store_key_path(key):
+    """Determine the path in CODE_STORE_ROOT for a store key
+    """
+    return '{0}/{1}/{2}'.format(CODE_STORE_ROOT, key[:2], key[2:])
+
+
+def manifest_store_paths(item):
+    """List the store paths that a code version links to, from its manifest
+
+    Arguments:
+        item {dict} -- code item
+
+    Returns:
+        list -- store paths, empty if the version has no manifest
     """
-    code_folder_current = '{0}/{1}/{2}/{2}-current'.format(
+    try:
+        with open(utilities.code_path(item) + '/' + STORE_MANIFEST) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return []
+    return sorted(set(store_key_path(key) for key in manifest.values()))
+
+
+def prune_store():
+    """Remove content from CODE_STORE_ROOT that no code version links to anymore
+
+    Returns:
+        int -- number of files removed
+    """
+    removed = 0
+    if not os.path.isdir(CODE_STORE_ROOT):
+        return removed
+    for root, directories, files in os.walk(CODE_STORE_ROOT):
+        for filename in files:
+            path = os.path.join(root, filename)
+            # The store holds the only link.
+            if os.lstat(path).st_nlink == 1:
+                os.remove(path)
+                removed += 1
+    log.info('Code | Store | Prune | Removed - %s', removed)
+    return removed
+
+
+def current_symlink_path(item):
+    """
+    Determine the path for the current symlink of a code item
+    """
+    return '{0}/{1}/{2}/{2}-current'.format(
         CODE_ROOT,
         utilities.code_type_directory_name(item['meta']['code_type']),
         item['meta']['name'])
+
+
+def update_symlink_current(item):
+    """
+    Determine the path for a code item
+    """
+    code_folder_current = current_symlink_path(item)
     # Remove symlink if it exists
     if os.path.islink(code_folder_current):
         os.unlink(code_folder_current)
@@ -79,15 +327,130 @@ def update_symlink_current(item):
     log.debug('Code deploy | Symlink | %s', code_folder_current)
 
 
-def sync_code():
+def code_drift(item):
+    """Check a code item on the local server without touching the git server
+
+    Arguments:
+        item {dict} -- code item
+
+    Returns:
+        string -- 'missing' if there is no checkout, 'head' if HEAD is not at commit_hash, 'current'
+        if the current symlink is wrong, or None if the item is deployed correctly
+    """
+    code_dir = utilities.code_path(item)
+    if not os.path.isdir(code_dir):
+        return 'missing'
+    try:
+        head = git.Repo(code_dir).head.commit.hexsha
+    except (ValueError, git.InvalidGitRepositoryError, git.NoSuchPathError):
+        head = None
+    if not (head and COMMIT_HASH_REGEX.match(item['commit_hash'])
+            and head.startswith(item['commit_hash'])):
+        return 'head'
+    if item['meta']['is_current']:
+        code_folder_current = current_symlink_path(item)
+        if not os.path.islink(code_folder_current) or \
+                os.readlink(code_folder_current) != code_dir:
+            return 'current'
+    return None
+
+
+def git_host(git_url):
+    """Determine the host for a git URL, like `github.com` for `git@github.com:org/repo.git`
+    """
+    if '://' in git_url:
+        return urlparse(git_url).hostname
+    # scp-like syntax, user@host:path
+    return git_url.split(':', 1)[0].split('@')[-1]
+
+
+def code_heal_items(items, workers=CODE_HEAL_MAX_WORKERS, per_host=CODE_HEAL_PER_GIT_HOST):
+    """Check code items locally and repair the ones that drifted
+
+    Every item is checked with `code_drift` in a pool of threads. Only drifted items are cloned or
+    checked out, with at most `per_host` running against each git host at once.
+
+    Arguments:
+        items {list} -- code items
+
+    Keyword Arguments:
+        workers {int} -- items to check or repair at the same time
+        per_host {int} -- repairs to run against one git host at the same time
+
+    Returns:
+        dict -- 'checked' count, 'drifted' list of dicts with '_id', 'name', 'version', 'drift',
+        'repaired' and 'error' on failure, 'changed' if anything was repaired, and 'duration'
+    """
+    start_time = time.time()
+    report = {'checked': len(items), 'drifted': [], 'changed': False}
+    if items:
+        pool = ThreadPool(min(workers, len(items)))
+        try:
+            drifts = pool.map(code_drift, items)
+            drifted = [(item, drift) for item, drift in zip(items, drifts) if drift]
+            semaphores = {}
+            for item, drift in drifted:
+                host = git_host(item['git_url'])
+                if host not in semaphores:
+                    semaphores[host] = threading.BoundedSemaphore(per_host)
+
+            def repair(entry):
+                item, drift = entry
+                result = {'_id': item['_id'], 'name': item['meta']['name'],
+                          'version': item['meta']['version'], 'drift': drift, 'repaired': False}
+                try:
+                    if drift != 'current':
+                        with semaphores[git_host(item['git_url'])]:
+                            if drift == 'missing':
+                                repository_clone(item)
+                            repository_checkout(item)
+                    if item['meta']['is_current']:
+                        update_symlink_current(item)
+                    result['repaired'] = True
+                except Exception as error:
+                    log.error('Code | Heal | Failed | Item - %s | Error - %s', item['_id'], error)
+                    result['error'] = str(error)
+                return result
+
+            report['drifted'] = pool.map(repair, drifted)
+        finally:
+            pool.close()
+            pool.join()
+    report['changed'] = any(result['repaired'] for result in report['drifted'])
+    report['duration'] = time.time() - start_time
+    log.info('Code | Heal | Checked - %s | Drifted - %s | Repaired - %s | Duration - %.2fs',
+             report['checked'], len(report['drifted']),
+             len([result for result in report['drifted'] if result['repaired']]),
+             report['duration'])
+    return report
+
+
+def sync_code(items=None):
     """Copy the code to all of the relevant nodes.
+
+    Keyword Arguments:
+        items {list} -- code items that were added, changed, or removed. Only their directories,
+            current symlinks, and static links are synced. Syncs all of the code root and
+            the static directory when empty. (default: {None})
+
+    Returns:
+        list -- result of the combined sync, see `utilities.sync_paths`
     """
-    log.info('Code | Sync')
-    hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
-    # Sync code root
-    utilities.sync(CODE_ROOT, hosts, CODE_ROOT)
-    # Sync static items
-    utilities.sync(WEB_ROOT + '/static', hosts, WEB_ROOT + '/static')
+    if not items:
+        log.info('Code | Sync | Full')
+        return [sync_operations.request_sync([CODE_ROOT, WEB_ROOT + '/static'])]
+    paths = []
+    for item in items:
+        paths.extend([utilities.code_path(item), current_symlink_path(item)])
+        if item['meta']['code_type'] == 'static':
+            paths.append(WEB_ROOT + '/static/' + item['meta']['name'])
+        if CODE_STORE_ROOT:
+            # Versions are hardlinks to the store and rsync only keeps links within one
+            # transfer, so send the store content the version links to, from its manifest.
+            # Content pruned from the store is removed from the hosts by the full reconcile.
+            paths.extend(manifest_store_paths(item))
+    log.info('Code | Sync | Items - %s | Paths - %s', len(items), len(paths))
+    return [sync_operations.request_sync(paths)]
 
 
 def deploy_static(item):
@@ -39,7 +39,7 @@ COMMANDS = [
     },
     {
         'machine_name': u'sync_instances',
-        'description': u'Sync instances to web servers.',
+        'description': u'Sync all instance files to web servers, not only the ones that changed.',
     },
     {
         'machine_name': u'correct_file_permissions',
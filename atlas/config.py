@@ -70,4 +70,98 @@ if ENVIRONMENT == 'local':
     # https://urllib3.readthedocs.io/en/latest/advanced-usage.html#ssl-warnings
     urllib3.disable_warnings()
 
+# Connection pooling for calls to the Atlas API. `API_POOL_CONNECTIONS` is the number of hosts to
+# keep a pool for, `API_POOL_MAXSIZE` is the number of connections kept open to each host.
+API_POOL_CONNECTIONS = 4
+API_POOL_MAXSIZE = 10
+# Retry idempotent requests that cannot connect or that get a gateway error. Sleeps
+# {backoff factor} * (2 ^ ({number of retries} - 1)) seconds between attempts.
+API_RETRIES = 3
+API_RETRY_BACKOFF_FACTOR = 0.5
+API_RETRY_STATUS_CODES = [502, 503, 504]
+# Seconds to wait for the (connect, read) phases of a request to the Atlas API.
+API_TIMEOUT = (5, 60)
+# Number of pages to fetch in parallel when iterating over a collection from the Atlas API.
+API_PAGE_CONCURRENCY = 4
+# Process local cache for single items requested from the Atlas API. Items are served from memory
+# for `API_CACHE_TTL` seconds, then revalidated against their `_etag`. Keep the TTL short enough to
+# only cover repeated lookups within one task, and only list resources whose records are safe to
+# serve slightly stale.
+API_CACHE_RESOURCES = ['code']
+API_CACHE_SIZE = 256
+API_CACHE_TTL = 5
+# Number of times to refetch the `_etag` and retry a write when the one we have is out of date.
+API_PRECONDITION_RETRIES = 3
+
+# Resources that accept bulk writes at `/bulk/<resource>`, by method.
+BULK_RESOURCES = {
+    'PATCH': ['sites', 'statistics', 'backup', 'code'],
+    'DELETE': ['sites', 'statistics', 'backup'],
+}
+# Number of items to send in each bulk request.
+BULK_BATCH_SIZE = 100
+
+# Seconds to serve the result of `/sites/aggregation` from memory before running the pipeline again.
+AGGREGATION_CACHE_TTL = 30
+
+# Seconds to trust a successful LDAP bind, and a failed one, before binding again.
+LDAP_AUTH_CACHE_TTL = 300
+LDAP_AUTH_CACHE_FAILURE_TTL = 30
+LDAP_AUTH_CACHE_SIZE = 1024
+# Keep one LDAP connection per process and rebind it for each login instead of connecting every
+# time.
+LDAP_PERSISTENT_CONNECTION = False
+# Seconds to wait for the LDAP server.
+LDAP_TIMEOUT = 5
+
+# Connections to keep open to the master database server in each process.
+DATABASE_POOL_SIZE = 4
+
+# Number of hosts to rsync to at the same time.
+SYNC_MAX_WORKERS = 8
+
+# Syncs requested by tasks are spooled here and combined, see `sync_operations`. A leader waits
+# `SYNC_DEBOUNCE` seconds for more requests before it runs rsync. Tasks waiting on a sync give up
+# after `SYNC_WAIT_TIMEOUT` seconds, keep it well below CELERYD_TASK_TIME_LIMIT so they can report
+# the failure.
+SYNC_SPOOL_DIR = '/tmp/atlas_sync'
+SYNC_DEBOUNCE = 2
+SYNC_WAIT_TIMEOUT = 600
+SYNC_POLL_INTERVAL = 0.5
+
+# Directory mtimes from the last permissions pass over each instance, so incremental passes can skip
+# directories that have not changed.
+PERMISSIONS_STATE_DIR = '/tmp/atlas_permissions'
+
+# Number of instances to correct permissions for at the same time, and per task when correcting
+# every instance. NFS latency dominates, so this can be well above the number of CPUs.
+PERMISSIONS_MAX_WORKERS = 16
+PERMISSIONS_BATCH_SIZE = 50
+# Soft time limit (seconds) for a task correcting a batch. Instances not started after
+# PERMISSIONS_BULK_STOP_AFTER are skipped and reported, so the walks in progress can finish in time.
+PERMISSIONS_BULK_TIME_LIMIT = 1800
+PERMISSIONS_BULK_STOP_AFTER = 1200
+# Instances waiting for a permissions pass after cron, and the most to take in one pass. The time
+# limit (seconds) for a pass is under the 15 minute schedule, so passes do not overlap. Instances
+# that are not done in time stay queued for the next pass.
+PERMISSIONS_QUEUE_DIR = PERMISSIONS_STATE_DIR + '/queue'
+PERMISSIONS_QUEUE_LIMIT = 100
+PERMISSIONS_QUEUE_TIME_LIMIT = 840
+
+# Bare mirrors of each git_url on the operations server, new code versions are cloned from the
+# local mirror and only fetch what it does not have. Keep it outside of CODE_ROOT, it is not synced.
+# Set to a path like '/data/code_mirrors' to use mirrors.
+CODE_MIRROR_ROOT = False
+
+# Code items to check at the same time during a heal, and the most clones or fetches to run against
+# one git host at the same time.
+CODE_HEAL_MAX_WORKERS = 16
+CODE_HEAL_PER_GIT_HOST = 4
+
+# Content addressed store for code files. When set, identical files in different code versions are
+# hardlinks to one copy in the store, and syncs preserve hardlinks so only new content is sent. The
+# store has to be in CODE_ROOT so it is synced with the versions that link to it.
+CODE_STORE_ROOT = False
+# CODE_STORE_ROOT = CODE_ROOT + '/.store'
+
 VERSION_NUMBER = '2.3.0-alpha6'
@@ -71,6 +71,9 @@ CELERY_ROUTES = {
     'atlas.tasks.remove_failed_backups': {
         'queue': 'atlas_queue'
     },
+    'atlas.tasks.correct_queued_file_permissions': {
+        'queue': 'maintenance_queue'
+    },
 }
 
 CELERYBEAT_SCHEDULE = {
@@ -150,4 +153,19 @@ CELERYBEAT_SCHEDULE = {
         'task': 'atlas.tasks.verify_statistics',
         'schedule': crontab(minute=0, hour=6),
     },
+    'correct_queued_file_permissions': {
+        'task': 'atlas.tasks.correct_queued_file_permissions',
+        'schedule': timedelta(minutes=15),
+    },
+    'reconcile_code': {
+        'task': 'atlas.tasks.code_reconcile',
+        'schedule': crontab(minute=0, hour=4),
+    },
+    'reconcile_instances': {
+        'task': 'atlas.tasks.instance_sync',
+        'schedule': crontab(minute=30, hour=4),
+        'kwargs': {
+            "full": True,
+        },
+    },
 }
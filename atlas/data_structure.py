@@ -861,6 +861,8 @@ DRUSH_SCHEMA = {
 """
 Definitions of Resources.
 Tells Eve what methods and schemas apply to a given resource.
+Eve creates the `mongo_indexes` at startup, they cover the queries that Atlas runs against each
+resource. See `benchmarks/query_indexes.py` to check them against a seeded database.
 """
 # Code resource
 CODE = {
@@ -870,6 +872,11 @@ CODE = {
     'versioning': True,
     'soft_delete': True,
     'schema': CODE_SCHEMA,
+    'mongo_indexes': {
+        'meta_name_code_type_is_current': [
+            ('meta.name', 1), ('meta.code_type', 1), ('meta.is_current', 1)],
+        'meta_is_current_created': [('meta.is_current', 1), ('_created', 1)],
+    },
 }
 
 # Query resource
@@ -894,6 +901,15 @@ SITES = {
     'versioning': True,
     'soft_delete': True,
     'schema': SITES_SCHEMA,
+    'mongo_indexes': {
+        'status': [('status', 1)],
+        'path': [('path', 1)],
+        'sid': [('sid', 1)],
+        'statistics': [('statistics', 1)],
+        'code_core': [('code.core', 1)],
+        'code_profile': [('code.profile', 1)],
+        'code_package': [('code.package', 1)],
+    },
 }
 
 # Statistics resource
@@ -904,6 +920,11 @@ STATISTICS = {
     'versioning': True,
     'soft_delete': True,
     'schema': STATISTICS_SCHEMA,
+    'mongo_indexes': {
+        'site': [('site', 1)],
+        'updated': [('_updated', 1)],
+        'status_days_since_last_edit': [('status', 1), ('days_since_last_edit', 1)],
+    },
 }
 
 # Backup resource
@@ -912,6 +933,11 @@ BACKUP = {
     'public_methods': ['GET'],
     'public_item_methods': ['GET'],
     'schema': BACKUP_SCHEMA,
+    'mongo_indexes': {
+        'site_created': [('site', 1), ('_created', 1)],
+        'state_backup_type_created': [('state', 1), ('backup_type', 1), ('_created', 1)],
+        'created': [('_created', 1)],
+    },
 }
 
 # Drush resource
@@ -214,7 +214,7 @@ def backup_create(site, backup_type):
     }
 
     log.debug('Backup | Create | Ready to update record | Payload - %s', patch_payload)
-    utilities.patch_eve('backup', backup_item['_id'], patch_payload)
+    utilities.patch_eve('backup', backup_item['_id'], patch_payload, etag=backup_item['_etag'])
 
     log.info('Operational statistic | Backup Create | SID - %s | Time - %s | DB size - %s | File size - %s',
              site['sid'], backup_time, db_size, file_size)
@@ -245,7 +245,7 @@ def backup_restore(backup_record, original_instance, package_list):
         if package_list:
             packages = {'code': {'package': package_list}}
             payload.update(packages)
-        utilities.patch_eve('sites', new_instance['_id'], payload)
+        utilities.patch_eve('sites', new_instance['_id'], payload, etag=new_instance['_etag'])
     else:
         exit('No available instances.')
 
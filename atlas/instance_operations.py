@@ -15,29 +15,62 @@
     # Backup - Remote - Create a database and NFS files backup of the instance.
     # Restore - Local - Restore files on an new instance; Remote - Restore database on instance.
 """
+import errno
+import filecmp
+import json
 import logging
 import os
 import re
 import stat
+import time
 
+from collections import OrderedDict
 from grp import getgrnam
+from multiprocessing.pool import ThreadPool
 from shutil import copyfile, rmtree
 from pwd import getpwuid
 
 from jinja2 import Environment, PackageLoader
 
 from atlas import utilities
+from atlas import sync_operations
 from atlas.config import (ENVIRONMENT, INSTANCE_ROOT, WEB_ROOT, CORE_WEB_ROOT_SYMLINKS,
                           NFS_MOUNT_FILES_DIR, NFS_MOUNT_LOCATION, SAML_AUTH,
                           SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD, VARNISH_CONTROL_KEY,
                           SMTP_PASSWORD, WEBSERVER_USER_GROUP, ATLAS_LOCATION, SITE_DOWN_PATH,
-                          SSH_USER, SERVICENOW_KEY)
+                          SSH_USER, SERVICENOW_KEY, PERMISSIONS_STATE_DIR,
+                          PERMISSIONS_MAX_WORKERS, PERMISSIONS_QUEUE_DIR)
 from atlas.config_servers import (SERVERDEFS, ATLAS_LOGGING_URLS, API_URLS,
                                   VARNISH_CONTROL_TERMINALS, BASE_URLS)
 
 # Setup a sub-logger. See tasks.py for longer comment.
 log = logging.getLogger('atlas.instance_operations')
 
+# Directory inside instances that is never synced.
+SYNC_EXCLUDE = 'opcache'
+
+# Paths with special permissions, see `correct_fs_permissions`.
+SITES_DEFAULT_REGEX = re.compile(r'sites\/default$', re.MULTILINE)
+SETTINGS_FILE_REGEX = re.compile(r'settings\.php$', re.MULTILINE)
+# Symlink targets in a Drupal core, see `switch_core`.
+CORE_DIRECTORY_REGEX = re.compile(r'((drupal)\-([\d\.x]+\-*[dev|alph|beta|rc|pl]*[\d]*))$i')
+# Usernames by uid, see `uid_name`.
+UID_NAMES = {}
+# Core manifests keyed on (_id, commit_hash), see `core_manifest`.
+CORE_MANIFESTS = {}
+# Directories in an instance that only hold symlinks from the layout, see `layout_diff`.
+LAYOUT_MANAGED_DIRECTORIES = ['', '/sites/all/modules', '/sites/all/themes', '/sites/all/libraries',
+                              '/profiles']
+
+
+def record_changes(paths):
+    """Record paths in INSTANCE_ROOT or WEB_ROOT that need to go out with the next sync.
+
+    Arguments:
+        paths {list} -- absolute paths that were added, changed, or removed
+    """
+    sync_operations.mark_dirty(paths, exclude=SYNC_EXCLUDE)
+
 
 def instance_create(instance, nfs_preserve=False):
     """Create symlink structure, settings file, and NFS space for an instance.
@@ -95,6 +128,7 @@ def instance_create(instance, nfs_preserve=False):
              instance['_id'], instance_code_path_current, instance_web_path_sid)
     utilities.relative_symlink(instance_code_path_sid, instance_code_path_current)
     utilities.relative_symlink(instance_code_path_current, instance_web_path_sid)
+    record_changes(['{0}/{1}'.format(INSTANCE_ROOT, instance['sid']), instance_web_path_sid])
     if instance['status'] in ['launched', 'launching']:
         switch_web_root_symlinks(instance)
 
@@ -138,6 +172,54 @@ def instance_delete(instance, nfs_preserve=False):
         # Check if it exists
         if os.access(directory, os.F_OK):
             rmtree(directory)
+    record_changes([instance_code_path, instance_web_path_sid, instance_web_path_path])
+
+
+def core_manifest(core):
+    """List what `switch_core` links and creates for a core.
+
+    A deployed core does not change without a new commit_hash, so the manifest is kept for the life
+    of the process. `code_update` and `code_remove` drop it with `forget_core_manifest`.
+
+    Arguments:
+        core {dict} -- code item for the core
+
+    Returns:
+        dict -- 'files' to symlink from the core, instance 'directories' to create, and core
+        'profiles' to symlink
+    """
+    key = (core['_id'], core.get('commit_hash'))
+    manifest = CORE_MANIFESTS.get(key)
+    if manifest is None:
+        core_path = utilities.code_path(core)
+        manifest = {
+            # Get a list of files in the Core source directory
+            'files': [core_file for core_file in utilities.filter_code_files(os.listdir(core_path))
+                      if core_file not in ['sites', 'profiles']],
+            # Create Instance specific directory structure
+            'directories': ['sites',
+                            'sites/all',
+                            'sites/all/modules',
+                            'sites/all/libraries',
+                            'sites/all/themes',
+                            'sites/default',
+                            'sites/default/files',
+                            'profiles'],
+            'profiles': os.listdir(core_path + '/profiles'),
+        }
+        log.debug('Instance | Core manifest | Core - %s | Manifest - %s', key, manifest)
+        CORE_MANIFESTS[key] = manifest
+    return manifest
+
+
+def forget_core_manifest(item):
+    """Drop the cached manifests for a code item, see `core_manifest`.
+
+    Arguments:
+        item {dict} -- code item
+    """
+    for key in [key for key in CORE_MANIFESTS.keys() if key[0] == item['_id']]:
+        CORE_MANIFESTS.pop(key, None)
 
 
 def switch_core(instance):
@@ -151,8 +233,7 @@ def switch_core(instance):
     # Setup variables
     core_path = utilities.code_path(core)
     instance_code_path_sid = '{0}/{1}/{1}'.format(INSTANCE_ROOT, instance['sid'])
-    # Get a list of files in the Core source directory
-    core_files = os.listdir(core_path)
+    manifest = core_manifest(core)
     # Get a list of files in the Instance target directory
     instance_files = os.listdir(instance_code_path_sid)
     # Remove any existing symlinks to a core.
@@ -165,15 +246,10 @@ def switch_core(instance):
             # Get the name of the directory that contains the symlink target
             code_dir = os.path.dirname(symlink_target)
             # Check to see if the directory is a Drupal core, if so remove the symlink.
-            regex = '((drupal)\-([\d\.x]+\-*[dev|alph|beta|rc|pl]*[\d]*))$i'
-            if re.match(regex, code_dir):
+            if CORE_DIRECTORY_REGEX.match(code_dir):
                 os.remove(full_path)
     # Iterate through the source files and symlink when applicable.
-    for core_file in core_files:
-        if core_file in ['sites', 'profiles']:
-            continue
-        if utilities.ignore_code_file(core_file):
-            continue
+    for core_file in manifest['files']:
         source_path = core_path + '/' + core_file
         destination_path = instance_code_path_sid + '/' + core_file
         # Remove existing symlink and add new one.
@@ -183,15 +259,7 @@ def switch_core(instance):
         if not os.access(destination_path, os.F_OK):
             utilities.relative_symlink(source_path, destination_path)
     # Create Instance specific directory structure
-    directories_to_create = ['sites',
-                             'sites/all',
-                             'sites/all/modules',
-                             'sites/all/libraries',
-                             'sites/all/themes',
-                             'sites/default',
-                             'sites/default/files',
-                             'profiles']
-    for directory in directories_to_create:
+    for directory in manifest['directories']:
         target_dir = instance_code_path_sid + '/' + directory
         # If the directoey does not already exist, create it.
         if not os.access(target_dir, os.F_OK):
@@ -204,8 +272,7 @@ def switch_core(instance):
     copyfile(source_path, destination_path)
     # Include links to the profiles that we are not using so that the site doesn't white screen if
     # the deployed profile gets disabled.
-    core_profiles = os.listdir(core_path + '/profiles')
-    for core_profile in core_profiles:
+    for core_profile in manifest['profiles']:
         source_path = core_path + '/profiles/' + core_profile
         destination_path = instance_code_path_sid + '/profiles/' + core_profile
         if os.path.islink(destination_path):
@@ -213,6 +280,7 @@ def switch_core(instance):
             # F_OK to test the existence of path
         if not os.access(destination_path, os.F_OK):
             utilities.relative_symlink(source_path, destination_path)
+    record_changes([instance_code_path_sid])
 
 
 def switch_profile(instance):
@@ -235,6 +303,7 @@ def switch_profile(instance):
     # Add new relative symlink
     if not os.access(destination_path, os.F_OK):
         utilities.relative_symlink(profile_path, destination_path)
+    record_changes([destination_path])
 
 
 def switch_packages(instance):
@@ -267,6 +336,204 @@ def switch_packages(instance):
             # Add new relative symlink
             if not os.access(destination_path, os.F_OK):
                 utilities.relative_symlink(package_path, destination_path)
+    record_changes([instance_code_path_sid + '/sites/all'])
+
+
+def instance_layout(instance):
+    """Describe the symlinks, directories, and copied files that an instance should have.
+
+    This is what `instance_create` builds with `switch_core`, `switch_profile`, `switch_packages`,
+    and `switch_web_root_symlinks`. The settings file is rendered by `switch_settings_files`.
+
+    Arguments:
+        instance {dict} -- full instance record
+
+    Returns:
+        OrderedDict -- (type, source) keyed on path, parents before children. Type is 'directory',
+        'symlink', 'absolute_symlink', or 'file' and source is the link target or the file to
+        copy. A 'symlink' points to source with a relative path, an 'absolute_symlink' with the
+        full path. Type 'absent' is a symlink to source that should not be there.
+    """
+    instance_code_path = '{0}/{1}'.format(INSTANCE_ROOT, instance['sid'])
+    instance_code_path_sid = '{0}/{1}/{1}'.format(INSTANCE_ROOT, instance['sid'])
+    instance_code_path_current = '{0}/{1}/current'.format(INSTANCE_ROOT, instance['sid'])
+    layout = OrderedDict()
+    layout[instance_code_path] = ('directory', None)
+    layout[instance_code_path_sid] = ('directory', None)
+    # Core
+    core = utilities.get_single_eve('code', instance['code']['core'])
+    core_path = utilities.code_path(core)
+    manifest = core_manifest(core)
+    for core_file in manifest['files']:
+        layout[instance_code_path_sid + '/' + core_file] = ('symlink', core_path + '/' + core_file)
+    for directory in manifest['directories']:
+        layout[instance_code_path_sid + '/' + directory] = ('directory', None)
+    layout[instance_code_path_sid + '/sites/default/default.settings.php'] = (
+        'file', core_path + '/sites/default/default.settings.php')
+    for core_profile in manifest['profiles']:
+        layout[instance_code_path_sid + '/profiles/' + core_profile] = (
+            'symlink', core_path + '/profiles/' + core_profile)
+    # Profile, replaces a core profile with the same name.
+    profile = utilities.get_single_eve('code', instance['code']['profile'])
+    layout[instance_code_path_sid + '/profiles/' + profile['meta']['name']] = (
+        'symlink', utilities.code_path(profile))
+    # Packages
+    for item in instance['code'].get('package', []):
+        package = utilities.get_single_eve('code', item)
+        package_type_path = utilities.code_type_directory_name(package['meta']['code_type'])
+        layout['{0}/sites/all/{1}/{2}'.format(
+            instance_code_path_sid, package_type_path, package['meta']['name'])] = (
+                'symlink', utilities.code_path(package))
+    # NFS mounted files directory, replaces the default files directory.
+    if NFS_MOUNT_FILES_DIR:
+        nfs_files_dir = NFS_MOUNT_LOCATION[ENVIRONMENT] + '/' + instance['sid']
+        for directory in [nfs_files_dir, nfs_files_dir + '/files', nfs_files_dir + '/tmp']:
+            layout[directory] = ('directory', None)
+        # Linked with the full path by `instance_create`, the mount is outside of the instance.
+        layout[instance_code_path_sid + '/sites/default/files'] = (
+            'absolute_symlink', nfs_files_dir + '/files')
+    # Symlinks for current in instance root, 'sid' and 'path' (if needed) in web root.
+    layout[instance_code_path_current] = ('symlink', instance_code_path_sid)
+    layout['{0}/{1}'.format(WEB_ROOT, instance['sid'])] = ('symlink', instance_code_path_current)
+    if instance['status'] in ['launched', 'launching'] and instance['type'] == 'express':
+        if instance['path'] == 'homepage':
+            for link in CORE_WEB_ROOT_SYMLINKS:
+                layout['{0}/{1}'.format(WEB_ROOT, link)] = (
+                    'symlink', '{0}/{1}'.format(instance_code_path_current, link))
+        elif instance['path'] != instance['sid']:
+            # If the instance has a multipart path, all items in 'path' except for the last one
+            if '/' in instance['path']:
+                base_path = WEB_ROOT + '/' + '/'.join(instance['path'].split('/')[:-1])
+                layout[base_path] = ('directory', None)
+            layout['{0}/{1}'.format(WEB_ROOT, instance['path'])] = (
+                'symlink', instance_code_path_current)
+    elif instance['path'] != instance['sid']:
+        # Not launched, so the path is not served.
+        layout['{0}/{1}'.format(WEB_ROOT, instance['path'])] = (
+            'absent', instance_code_path_current)
+    return layout
+
+
+def layout_diff(layout, managed_directories):
+    """Compare a layout with what is on disk.
+
+    Each path is checked with a single `lstat`. Symlinks in `managed_directories` that are not in
+    the layout, like packages that were removed, are removed. Anything else that is not in the
+    layout is left alone.
+
+    Arguments:
+        layout {OrderedDict} -- see `instance_layout`
+        managed_directories {list} -- directories that should only hold symlinks from the layout
+
+    Returns:
+        list -- changes, dicts with 'action', 'path', 'source', and 'absolute'. Action is one of
+        'mkdir', 'link', 'relink', 'copy', 'unlink', or 'conflict' when something that is not a
+        symlink is in the way. Absolute is True when the link should use the full source path.
+    """
+    changes = []
+    for path, (kind, source) in layout.items():
+        try:
+            stats = os.lstat(path)
+        except OSError:
+            stats = None
+        action = None
+        absolute = kind == 'absolute_symlink'
+        if kind == 'directory':
+            if stats is None:
+                action = 'mkdir'
+            elif not stat.S_ISDIR(stats.st_mode):
+                action = 'conflict'
+        elif kind in ['symlink', 'absolute_symlink']:
+            if absolute:
+                target = source
+            else:
+                target = os.path.relpath(source, os.path.dirname(path))
+            if stats is None:
+                action = 'link'
+            elif stat.S_ISLNK(stats.st_mode):
+                if os.readlink(path) != target:
+                    action = 'relink'
+            elif stat.S_ISDIR(stats.st_mode) and not os.listdir(path):
+                # An empty directory, like the default files directory.
+                action = 'link'
+            else:
+                action = 'conflict'
+        elif kind == 'file':
+            if stats is None or not filecmp.cmp(source, path, shallow=False):
+                action = 'copy'
+        elif kind == 'absent':
+            # Only remove a link to this source, the path may belong to something else now.
+            if stats is not None and stat.S_ISLNK(stats.st_mode) and \
+                    os.readlink(path) == os.path.relpath(source, os.path.dirname(path)):
+                action = 'unlink'
+        if action:
+            changes.append({'action': action, 'path': path, 'source': source,
+                            'absolute': absolute})
+
+    for directory in managed_directories:
+        if os.path.islink(directory) or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = directory + '/' + name
+            if path not in layout and os.path.islink(path):
+                changes.append({'action': 'unlink', 'path': path, 'source': None,
+                                'absolute': False})
+    return changes
+
+
+def apply_layout(instance, dry_run=False):
+    """Bring the files for an instance in line with `instance_layout`, changing only what differs.
+
+    Arguments:
+        instance {dict} -- full instance record
+
+    Keyword Arguments:
+        dry_run {bool} -- only report the changes (default: {False})
+
+    Returns:
+        list -- changes, see `layout_diff`
+    """
+    instance_code_path_sid = '{0}/{1}/{1}'.format(INSTANCE_ROOT, instance['sid'])
+    changes = layout_diff(instance_layout(instance),
+                          [instance_code_path_sid + directory
+                           for directory in LAYOUT_MANAGED_DIRECTORIES])
+    log.info('Instance | Layout | Instance - %s | Dry run - %s | Changes - %s',
+             instance['sid'], dry_run, len(changes))
+    if dry_run:
+        for change in changes:
+            log.info('Instance | Layout | Drift | Instance - %s | %s - %s', instance['sid'],
+                     change['action'], change['path'])
+        return changes
+
+    changed = []
+    for change in changes:
+        action, path, source = change['action'], change['path'], change['source']
+        log.debug('Instance | Layout | Instance - %s | %s - %s', instance['sid'], action, path)
+        if action == 'conflict':
+            log.error('Instance | Layout | Instance - %s | Path is in the way - %s',
+                      instance['sid'], path)
+            continue
+        if action == 'mkdir':
+            os.makedirs(path)
+        elif action == 'copy':
+            if os.access(path, os.F_OK):
+                os.remove(path)
+            copyfile(source, path)
+        elif action == 'unlink':
+            os.remove(path)
+        else:
+            if action == 'relink':
+                os.remove(path)
+            elif os.path.isdir(path):
+                os.rmdir(path)
+            if change['absolute']:
+                os.symlink(source, path)
+            else:
+                utilities.relative_symlink(source, path)
+        changed.append(path)
+    if changed:
+        record_changes(changed)
+    return changes
 
 
 def switch_settings_files(instance):
@@ -350,8 +617,12 @@ def switch_settings_files(instance):
     jinja_env = Environment(loader=PackageLoader('atlas', 'templates'))
     template = jinja_env.get_template('settings.php')
     render = template.render(settings_variables)
-    # Remove the existing file.
     if os.access(file_destination, os.F_OK):
+        with open(file_destination, 'rb') as open_file:
+            if open_file.read() == render:
+                log.info('Instance | Settings file | Unchanged | Instance ID - %s', instance['_id'])
+                return
+        # Remove the existing file.
         os.remove(file_destination)
     # Write the render to a file.
     with open(file_destination, "wb") as open_file:
@@ -359,99 +630,352 @@ def switch_settings_files(instance):
     # Set file permissions
     # Octet mode, Python 3 compatible
     os.chmod(file_destination, 0o444)
+    record_changes([file_destination])
+
+
+def uid_name(uid):
+    """Look up a username by uid, caching the result for the life of the process.
+
+    Arguments:
+        uid {int} -- user id
+    """
+    if uid not in UID_NAMES:
+        UID_NAMES[uid] = getpwuid(uid).pw_name
+    return UID_NAMES[uid]
 
 
-def correct_fs_permissions(instance):
+def permissions_state_path(instance, tree):
+    """Path to the file that remembers directory mtimes from the last pass over a tree.
+
+    Arguments:
+        instance {dict} -- instance object
+        tree {string} -- 'code' or 'nfs'
+    """
+    return '{0}/{1}_{2}.json'.format(PERMISSIONS_STATE_DIR, instance['sid'], tree)
+
+
+def load_permissions_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_permissions_state(path, state):
+    try:
+        os.makedirs(PERMISSIONS_STATE_DIR)
+    except OSError as error:
+        # Another instance in the pool created it first.
+        if error.errno != errno.EEXIST:
+            raise
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+
+
+def fix_permissions(path, stats, mode, gid, counts):
+    """Change the mode and group of a path, only making the calls that are needed.
+
+    Arguments:
+        path {string} -- path to fix
+        stats {stat_result} -- stat of the path
+        mode {int} -- permission bits wanted
+        gid {int} -- group id wanted, None to leave the group alone
+        counts {dict} -- running counts for the pass
+    """
+    counts['checked'] += 1
+    changed = False
+    if stat.S_IMODE(stats.st_mode) != mode:
+        os.chmod(path, mode)
+        changed = True
+    if gid is not None and stats.st_gid != gid:
+        # User id (uid) -1 leaves it unchanged.
+        os.chown(path, -1, gid)
+        changed = True
+    if changed:
+        counts['changed'] += 1
+
+
+def correct_tree_permissions(root, directory_rule, file_rule, state, counts):
+    """Walk a tree and fix permissions, stating each entry once.
+
+    With a `state` from a previous pass, files in directories whose mtime has not changed are
+    skipped. Subdirectories are always visited, since a change deep in the tree does not change
+    the mtime of its parents.
+
+    Arguments:
+        root {string} -- top of the tree, its own permissions are left alone
+        directory_rule {function} -- takes (path, stats), returns (mode, gid) or None to skip
+        file_rule {function} -- takes (path, stats), returns (mode, gid) or None to skip
+        state {dict} -- previous pass, keyed on directory, of [mtime, [subdirectory names]]
+        counts {dict} -- running counts for the pass
+
+    Returns:
+        dict -- state for the next pass
+    """
+    new_state = {}
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            directory_stats = os.lstat(directory)
+        except OSError:
+            # Removed while we were walking.
+            continue
+        if directory != root:
+            rule = directory_rule(directory, directory_stats)
+            if rule:
+                fix_permissions(directory, directory_stats, rule[0], rule[1], counts)
+        previous = state.get(directory)
+        if previous and previous[0] == directory_stats.st_mtime:
+            counts['skipped'] += 1
+            new_state[directory] = previous
+            stack.extend(os.path.join(directory, name) for name in previous[1])
+            continue
+        subdirectories = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stats = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(stats.st_mode):
+                subdirectories.append(name)
+                continue
+            if stat.S_ISLNK(stats.st_mode):
+                # Symlinked directories are left alone. Symlinked files are fixed through their
+                # target, like `chmod` does.
+                try:
+                    stats = os.stat(path)
+                except OSError:
+                    log.debug('Instance | Correct FS permissions | Broken symlink - %s', path)
+                    continue
+                if stat.S_ISDIR(stats.st_mode):
+                    continue
+            rule = file_rule(path, stats)
+            if rule:
+                fix_permissions(path, stats, rule[0], rule[1], counts)
+        new_state[directory] = [directory_stats.st_mtime, subdirectories]
+        stack.extend(os.path.join(directory, name) for name in subdirectories)
+    return new_state
+
+
+def correct_fs_permissions(instance, incremental=False):
     """Apply the correct permissions to code and NFS files, directories, and symlinks.
 
+    Only entries whose mode or group is wrong are changed. With `incremental`, files are only
+    checked in directories that changed since the last pass, see `correct_tree_permissions`.
+
     Arguments:
         instance {dict} -- instance object
+        incremental {bool} -- skip directories that have not changed (default: {False})
+
+    Returns:
+        dict -- counts of entries 'checked' and 'changed', and directories 'skipped'
     """
-    log.info('Instance | Correct File permissions | Instance - %s', instance['sid'])
+    log.info('Instance | Correct File permissions | Instance - %s | Incremental - %s',
+             instance['sid'], incremental)
     instance_path = "{0}/{1}/{1}".format(INSTANCE_ROOT, instance['sid'])
-    # Walk produces 3-tuple for each dir or file, does not follow symlinks.
     # Lookup gid (Group ID), `chown` uses IDs for user and group
     group = getgrnam(WEBSERVER_USER_GROUP)
     log.debug('Instance | Correct FS permissions | Group - %s', group)
-    # `os.walk` does not follow symlinks by default.
-    for root, directories, files in os.walk(instance_path, topdown=False):
-        # Change directory permissions.
-        for directory in [os.path.join(root, d) for d in directories]:
-            # Do not need to update perms on symlinks
-            if not os.path.islink(directory):
-                if re.search('sites\/default$', directory, re.MULTILINE):
-                    # Octet mode, Python 3 compatible
-                    os.chmod(directory, 0o755)
-                else:
-                    os.chmod(directory, 0o775)
-                # All the arguments to fchown are integers. Integer 'file descriptor' that
-                # is used by the underlying implementation to request I/O operations from
-                # the operating system; user id (uid), -1 to leave it unchanged; group id
-                # (gid).
-                log.debug('path %s | gid %s', directory, group.gr_gid)
-                os.chown(directory, -1, group.gr_gid)
-        # Change file permissions.
-        for file in [os.path.join(root, f) for f in files]:
-            log.debug('Instance | Correcy FS perms | File | File name - %s', file)
-            # Use search instead of match b/c we want end of string, not exact string, silly dev.
-            if re.search('settings\.php$', file, re.MULTILINE):
-                # Octet mode, Python 3 compatible
-                os.chmod(file, 0o444)
-                log.debug('Instance | Correcy FS perms | File | File name - %s | 444', file)
-            else:
-                os.chmod(file, 0o664)
-                log.debug('Instance | Correcy FS perms | File | File name - %s | 664', file)
-            os.chown(file, -1, group.gr_gid)
+    counts = {'checked': 0, 'changed': 0, 'skipped': 0}
+
+    def code_directory_rule(path, stats):
+        if SITES_DEFAULT_REGEX.search(path):
+            # Octet mode, Python 3 compatible
+            return 0o755, group.gr_gid
+        return 0o775, group.gr_gid
+
+    def code_file_rule(path, stats):
+        # Use search instead of match b/c we want end of string, not exact string, silly dev.
+        if SETTINGS_FILE_REGEX.search(path):
+            return 0o444, group.gr_gid
+        return 0o664, group.gr_gid
+
+    def nfs_gid(stats):
+        # Check if we own the file, don't try to change the group if we don't
+        # TODO Remove ownership check when the umask is in place.
+        if not ENVIRONMENT == 'local' and uid_name(stats.st_uid) == SSH_USER:
+            return group.gr_gid
+        return None
+
+    def nfs_directory_rule(path, stats):
+        # Include SetGID for directory
+        return 0o2775, nfs_gid(stats)
+
+    def nfs_file_rule(path, stats):
+        return 0o664, nfs_gid(stats)
+
+    trees = [('code', instance_path, code_directory_rule, code_file_rule)]
     if NFS_MOUNT_FILES_DIR:
-        nfs_files_dir = '{0}/{1}'.format(NFS_MOUNT_LOCATION[ENVIRONMENT], instance['sid'])
         # Files and directories all owned by Apache
         # Diretories have setgid on them
-        log.debug('Instance | Correct NFS permissions | Group - %s', group)
-        for root, directories, files in os.walk(nfs_files_dir, topdown=False):
-            for directory in [os.path.join(root, d) for d in directories]:
-                # Do not need to update perms on symlinks
-                # Check if we own the file, don't try to change the perms if we don't
-                # TODO Remove ownership check when the umask is in place.
-                if not os.path.islink(directory):
-                    # Octet mode, Python 3 compatible
-                    # Include SetGID for directory
-                    os.chmod(directory, 02775)
-                    if not ENVIRONMENT == 'local' and getpwuid(os.stat(directory).st_uid).pw_name == SSH_USER:
-                        os.chown(directory, -1, group.gr_gid)
-            for file in [os.path.join(root, f) for f in files]:
-                # Check if we own the file, don't try to change the perms if we don't
-                # TODO Remove ownership check when the umask is in place.
-                os.chmod(file, 0o664)
-                if not ENVIRONMENT == 'local' and getpwuid(os.stat(file).st_uid).pw_name == SSH_USER:
-                    # Octet mode, Python 3 compatible
-                    os.chown(file, -1, group.gr_gid)
-
-
-def sync_instances(sid=None):
-    """Copy the instance files to all of the relevant nodes.
+        nfs_files_dir = '{0}/{1}'.format(NFS_MOUNT_LOCATION[ENVIRONMENT], instance['sid'])
+        trees.append(('nfs', nfs_files_dir, nfs_directory_rule, nfs_file_rule))
+
+    code_changed = 0
+    for tree, root, directory_rule, file_rule in trees:
+        if not os.path.isdir(root):
+            continue
+        state_path = permissions_state_path(instance, tree)
+        state = load_permissions_state(state_path) if incremental else {}
+        new_state = correct_tree_permissions(root, directory_rule, file_rule, state, counts)
+        # Only keep state from a pass that finished.
+        save_permissions_state(state_path, new_state)
+        if tree == 'code':
+            code_changed = counts['changed']
+
+    # Only the code tree is synced, NFS is shared.
+    if code_changed:
+        record_changes([instance_path])
+    log.info('Instance | Correct File permissions | Instance - %s | Checked - %s | Changed - %s | '
+             'Skipped directories - %s', instance['sid'], counts['checked'], counts['changed'],
+             counts['skipped'])
+    return counts
+
+
+def correct_fs_permissions_bulk(instances, incremental=False, workers=PERMISSIONS_MAX_WORKERS,
+                                stop_after=None):
+    """Apply the correct permissions to many instances at once.
+
+    Walking NFS is mostly waiting on metadata round trips, so instances are walked in a pool of
+    threads. A failure in one instance is logged and reported without stopping the rest.
+
+    Arguments:
+        instances {list} -- instance objects
+        incremental {bool} -- see `correct_fs_permissions` (default: {False})
+        workers {int} -- number of instances to walk at the same time
+        stop_after {int} -- seconds after which instances that have not been started are skipped,
+            so the pass can finish inside a time limit (default: {None})
+
+    Returns:
+        dict -- counts for each instance keyed on sid, totals, 'skipped', 'duration', and
+        'entries_per_sec'. Skipped instances have {'skipped': True} for counts.
+    """
+    log.info('Instances | Correct File permissions | Bulk | Count - %s | Workers - %s',
+             len(instances), workers)
+    start_time = time.time()
+
+    def correct(instance):
+        if stop_after is not None and time.time() - start_time > stop_after:
+            return instance['sid'], {'skipped': True}
+        try:
+            return instance['sid'], correct_fs_permissions(instance, incremental=incremental)
+        except Exception as error:
+            log.error('Instances | Correct File permissions | Bulk | Instance - %s | Error - %s',
+                      instance['sid'], error)
+            return instance['sid'], {'error': str(error)}
+
+    results = []
+    if instances:
+        pool = ThreadPool(min(workers, len(instances)))
+        try:
+            results = pool.map(correct, instances)
+        finally:
+            pool.close()
+            pool.join()
+
+    report = {
+        'instances': dict(results),
+        'checked': sum(counts.get('checked', 0) for sid, counts in results),
+        'changed': sum(counts.get('changed', 0) for sid, counts in results),
+        'failed': len([sid for sid, counts in results if 'error' in counts]),
+        'skipped': len([sid for sid, counts in results if 'skipped' in counts]),
+        'duration': time.time() - start_time,
+    }
+    report['entries_per_sec'] = (report['checked'] / report['duration']
+                                 if report['duration'] else None)
+    log.info('Instances | Correct File permissions | Bulk | Instances - %s | Checked - %s | '
+             'Changed - %s | Failed - %s | Skipped - %s | Duration - %.2fs | Entries/sec - %s',
+             len(instances), report['checked'], report['changed'], report['failed'],
+             report['skipped'], report['duration'], report['entries_per_sec'])
+    return report
+
+
+def queue_permissions_fix(instance):
+    """Ask for the permissions of an instance to be corrected later, see
+    `drain_permissions_queue`. Asking again before the queue is drained does nothing more.
+
+    Arguments:
+        instance {dict} -- instance object
+    """
+    if not os.path.isdir(PERMISSIONS_QUEUE_DIR):
+        try:
+            os.makedirs(PERMISSIONS_QUEUE_DIR)
+        except OSError:
+            # Another process created it.
+            pass
+    # The file name is the sid, so repeated requests collapse into one.
+    with open('{0}/{1}'.format(PERMISSIONS_QUEUE_DIR, instance['sid']), 'w') as f:
+        f.write(str(time.time()))
+
+
+def drain_permissions_queue(limit=None):
+    """Correct permissions for the instances in the queue, see `queue_permissions_fix`.
+
+    An instance stays in the queue until it has been corrected, so one that fails or is cut off
+    by the task time limit is tried again on the next pass.
 
     Keyword Arguments:
-        sid {string} -- p1 sid for an instance (default: {None})
+        limit {int} -- most instances to take from the queue (default: {None})
+
+    Returns:
+        dict -- see `correct_fs_permissions_bulk`
     """
+    if not os.path.isdir(PERMISSIONS_QUEUE_DIR):
+        return correct_fs_permissions_bulk([])
+    requests = {}
+    for sid in sorted(os.listdir(PERMISSIONS_QUEUE_DIR))[:limit]:
+        try:
+            with open('{0}/{1}'.format(PERMISSIONS_QUEUE_DIR, sid)) as f:
+                requests[sid] = f.read()
+        except IOError:
+            continue
+    log.info('Instances | Permissions queue | Count - %s', len(requests))
+    report = correct_fs_permissions_bulk([{'sid': sid} for sid in sorted(requests)],
+                                         incremental=True)
+    for sid, counts in report['instances'].items():
+        if 'error' in counts or 'skipped' in counts:
+            continue
+        marker = '{0}/{1}'.format(PERMISSIONS_QUEUE_DIR, sid)
+        try:
+            with open(marker) as f:
+                # A request that came in during the walk is kept for the next pass.
+                if f.read() != requests[sid]:
+                    continue
+            os.remove(marker)
+        except (IOError, OSError):
+            continue
+    return report
 
-    log.info('Instances | Sync | id - %s', sid)
-    hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
-    # Sync INSTANCE_ROOT then WEB_ROOT
-    if sid:
-        sid_local_instance_root = INSTANCE_ROOT + '/' + sid
-        sid_instance_root = INSTANCE_ROOT + '/' + sid
-        utilities.sync(sid_local_instance_root, hosts, sid_instance_root, exclude='opcache')
-    else:
-        utilities.sync(INSTANCE_ROOT, hosts, INSTANCE_ROOT, exclude='opcache')
-    sync_web_root()
+
+def sync_instances(full=False):
+    """Copy changed instance files to all of the relevant nodes.
+
+    Only the paths recorded by `record_changes` are synced. Requests go through
+    `sync_operations`, so syncs from many tasks at once are combined.
+
+    Keyword Arguments:
+        full {bool} -- sync all of INSTANCE_ROOT and WEB_ROOT, to reconcile the nodes
+            (default: {False})
+
+    Returns:
+        dict -- result of the combined sync, see `utilities.sync_paths`
+    """
+
+    log.info('Instances | Sync | Full - %s', full)
+    paths = [INSTANCE_ROOT, WEB_ROOT] if full else []
+    return sync_operations.request_sync(paths, exclude=SYNC_EXCLUDE)
 
 
 def sync_web_root():
-    """Copy web root symlinks and directories to the relevant nodes.
+    """Copy changed web root symlinks and directories to the relevant nodes.
     """
     log.info('Instances | Sync | Web root')
-    hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
-    utilities.sync(WEB_ROOT, hosts, WEB_ROOT, exclude='opcache')
+    return sync_instances()
 
 
 def switch_web_root_symlinks(instance):
@@ -488,6 +1012,7 @@ def switch_web_root_symlinks(instance):
                 if instance['path'] != instance['sid']:
                     utilities.relative_symlink(
                         instance_code_path_current, web_directory_path)
+            record_changes([web_directory_path, web_directory_sid])
         elif instance['path'] == 'homepage':
             for link in CORE_WEB_ROOT_SYMLINKS:
                 source_path = "{0}/{1}".format(instance_code_path_current, link)
@@ -495,6 +1020,7 @@ def switch_web_root_symlinks(instance):
                 if os.access(target_path, os.F_OK) and os.path.islink(target_path):
                     os.remove(target_path)
                 utilities.relative_symlink(source_path, target_path)
+            record_changes(["{0}/{1}".format(WEB_ROOT, link) for link in CORE_WEB_ROOT_SYMLINKS])
 
 
 def switch_homepage_files():
@@ -506,3 +1032,4 @@ def switch_homepage_files():
         if os.access(file[1], os.F_OK):
             os.remove(file[1])
         copyfile(file[0], file[1])
+    record_changes([file[1] for file in files])
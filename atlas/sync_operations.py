@@ -0,0 +1,238 @@
+"""
+    atlas.sync_operations
+    ~~~~
+    Coalesce requests to sync files to the other servers.
+
+    Celery tasks run in separate processes, so requests are written to a spool directory. The first
+    process to get the leader lock waits SYNC_DEBOUNCE seconds for other requests to arrive, then
+    merges every pending request into one rsync per host and writes a result for the requests
+    that are waiting on it. It keeps going until the spool is empty, so requests that arrive during
+    a sync are picked up by the next one.
+
+    A request is always written before its process tries for the lock, and the leader checks the
+    spool again after it lets go of the lock, so no request is left behind.
+
+    Operations that change files record the paths with `mark_dirty`. The leader adds every dirty
+    path to the next sync, so a request with no paths syncs whatever has changed. Marks are read
+    after requests, so anything marked before a request is in the sync that answers it.
+
+    The leader moves what it reads to an in flight directory and only removes it once the sync is
+    done. Paths from a failed sync are marked dirty again, and the next leader puts back anything
+    left in flight by a leader that was killed.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+
+from atlas import utilities
+from atlas.config import (ENVIRONMENT, SYNC_SPOOL_DIR, SYNC_DEBOUNCE, SYNC_WAIT_TIMEOUT,
+                          SYNC_POLL_INTERVAL)
+from atlas.config_servers import (SERVERDEFS)
+
+# Setup a sub-logger. See tasks.py for longer comment.
+log = logging.getLogger('atlas.sync_operations')
+
+PENDING_DIR = os.path.join(SYNC_SPOOL_DIR, 'pending')
+DONE_DIR = os.path.join(SYNC_SPOOL_DIR, 'done')
+DIRTY_DIR = os.path.join(SYNC_SPOOL_DIR, 'dirty')
+INFLIGHT_DIR = os.path.join(SYNC_SPOOL_DIR, 'inflight')
+LOCK_FILE = os.path.join(SYNC_SPOOL_DIR, 'leader.lock')
+
+
+def spool_setup():
+    """
+    Create the spool directories.
+    """
+    for directory in [PENDING_DIR, DONE_DIR, DIRTY_DIR, INFLIGHT_DIR]:
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+
+def write_json(path, data):
+    """
+    Write a file atomically, so the leader and waiters never read a partial file.
+    """
+    tmp_path = os.path.join(SYNC_SPOOL_DIR, '.{0}.tmp'.format(uuid.uuid4().hex))
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+
+def merge_paths(paths):
+    """
+    Remove duplicate paths and paths that are inside another path in the list.
+
+    :param paths: list of absolute paths
+    :return: sorted list of paths
+    """
+    merged = []
+    for path in sorted(set(os.path.normpath(path) for path in paths)):
+        if merged and (path == merged[-1] or path.startswith(merged[-1].rstrip('/') + '/')):
+            continue
+        merged.append(path)
+    return merged
+
+
+def mark_dirty(paths, exclude=None):
+    """
+    Record paths that changed and need to go out with the next sync.
+
+    :param paths: list of absolute paths, removed paths are removed from the hosts
+    :param exclude: directory to exclude from rsync, see `request_sync`
+    """
+    spool_setup()
+    log.debug('Sync | Dirty | Paths - %s | Exclude - %s', paths, exclude)
+    write_json(os.path.join(DIRTY_DIR, uuid.uuid4().hex + '.json'),
+               {'paths': paths, 'exclude': exclude})
+
+
+def read_spool(directory):
+    """
+    Move every file in a spool directory to INFLIGHT_DIR and read it. The in flight files are
+    removed with `finish_inflight` once they are handled.
+
+    :return: list of the decoded files
+    """
+    items = []
+    prefix = os.path.basename(directory) + '-'
+    for filename in os.listdir(directory):
+        path = os.path.join(INFLIGHT_DIR, prefix + filename)
+        try:
+            os.rename(os.path.join(directory, filename), path)
+            with open(path) as f:
+                items.append(json.load(f))
+        except (IOError, OSError, ValueError) as error:
+            log.error('Sync | Spool | Cannot read - %s | %s', path, error)
+    return items
+
+
+def recover_inflight():
+    """
+    Put files left in flight by a leader that did not finish back in the spool.
+    """
+    for filename in os.listdir(INFLIGHT_DIR):
+        directory, original = filename.split('-', 1)
+        log.warning('Sync | Spool | Recover - %s', filename)
+        os.rename(os.path.join(INFLIGHT_DIR, filename),
+                  os.path.join(SYNC_SPOOL_DIR, directory, original))
+
+
+def finish_inflight():
+    """
+    Remove the in flight files once they are handled.
+    """
+    for filename in os.listdir(INFLIGHT_DIR):
+        os.remove(os.path.join(INFLIGHT_DIR, filename))
+
+
+def request_sync(paths, exclude=None, wait=True):
+    """
+    Ask for paths to be synced to the webservers and operations server.
+
+    :param paths: list of absolute paths, directories are synced with their contents. Dirty paths
+        are always included, so this can be empty.
+    :param exclude: directory to exclude from rsync, requests are only merged with requests that
+        have the same exclude
+    :param wait: Wait for the sync that includes these paths to finish
+    :return: result from `utilities.sync_paths` for the combined sync if waiting, otherwise None
+    """
+    spool_setup()
+    request_id = uuid.uuid4().hex
+    log.info('Sync | Request | ID - %s | Paths - %s | Exclude - %s', request_id, paths, exclude)
+    write_json(os.path.join(PENDING_DIR, request_id + '.json'),
+               {'id': request_id, 'paths': paths, 'exclude': exclude, 'wait': wait})
+    lead()
+    if not wait:
+        return None
+
+    done_path = os.path.join(DONE_DIR, request_id + '.json')
+    deadline = time.time() + SYNC_WAIT_TIMEOUT
+    while not os.path.exists(done_path):
+        if time.time() > deadline:
+            log.error('Sync | Request | ID - %s | Timed out waiting for sync', request_id)
+            return {'source': paths, 'success': False, 'duration': SYNC_WAIT_TIMEOUT, 'hosts': {}}
+        time.sleep(SYNC_POLL_INTERVAL)
+        # The leader may have finished between our request and its last check, so take over.
+        lead()
+    with open(done_path) as f:
+        result = json.load(f)
+    os.remove(done_path)
+    log.info('Sync | Request | ID - %s | Success - %s', request_id, result['success'])
+    return result
+
+
+def lead():
+    """
+    Process the spool if no other process is, until there is nothing left to sync.
+    """
+    while True:
+        lock = open(LOCK_FILE, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            lock.close()
+            if error.errno in [errno.EAGAIN, errno.EACCES]:
+                # Another process is the leader.
+                return
+            raise
+        try:
+            recover_inflight()
+            time.sleep(SYNC_DEBOUNCE)
+            process_pending()
+            # Keep going while there are requests. Marks from a failed sync wait for the next
+            # request, so a host that is down is not retried in a loop.
+            while os.listdir(PENDING_DIR):
+                process_pending()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        # A request written while we held the lock may have given up on leading.
+        if not os.listdir(PENDING_DIR):
+            return
+
+
+def process_pending():
+    """
+    Run one combined sync for each exclude in the spool.
+
+    :return: True if there was anything to sync
+    """
+    requests = read_spool(PENDING_DIR)
+    dirty = read_spool(DIRTY_DIR)
+    if not requests and not dirty:
+        finish_inflight()
+        return False
+
+    groups = {}
+    for item in requests + dirty:
+        groups.setdefault(item['exclude'], []).append(item)
+    hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
+    for exclude, group in groups.items():
+        paths = merge_paths(path for item in group for path in item['paths'])
+        log.info('Sync | Combined | Items - %s | Paths - %s | Exclude - %s',
+                 len(group), paths, exclude)
+        if paths:
+            try:
+                result = utilities.sync_paths(paths, hosts, exclude=exclude)
+            except Exception as error:
+                log.error('Sync | Combined | Failed | Paths - %s | Error - %s', paths, error)
+                result = {'source': paths, 'success': False, 'duration': 0, 'hosts': {},
+                          'error': str(error)}
+        else:
+            log.info('Sync | Combined | Nothing has changed')
+            result = {'source': paths, 'success': True, 'duration': 0, 'hosts': {}}
+        if not result['success'] and paths:
+            # Sync these paths with the next one.
+            mark_dirty(paths, exclude=exclude)
+        for item in group:
+            if item.get('wait'):
+                write_json(os.path.join(DONE_DIR, item['id'] + '.json'), result)
+    finish_inflight()
+    return True
@@ -14,6 +14,8 @@ from math import ceil
 from random import randint
 import requests
 from celery import Celery, chord
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import task_postrun
 from celery.utils.log import get_task_logger
 from fabric.api import execute
 from git import GitCommandError
@@ -21,7 +23,9 @@ from git import GitCommandError
 from atlas import fabric_tasks, utilities, config_celery
 from atlas import code_operations, instance_operations, backup_operations
 from atlas.config import (ENVIRONMENT, WEBSERVER_USER, DESIRED_SITE_COUNT, EMAIL_HOST,
-                          SSL_VERIFICATION, CODE_ROOT, BACKUPS_LARGE_INSTANCES)
+                          SSL_VERIFICATION, BACKUPS_LARGE_INSTANCES,
+                          PERMISSIONS_QUEUE_LIMIT, PERMISSIONS_QUEUE_TIME_LIMIT,
+                          PERMISSIONS_BULK_TIME_LIMIT, PERMISSIONS_BULK_STOP_AFTER)
 from atlas.config_servers import (BASE_URLS, API_URLS)
 
 # Setup a sub-logger
@@ -35,6 +39,19 @@ celery = Celery('tasks')
 celery.config_from_object(config_celery)
 
 
+@task_postrun.connect
+def report_api_session_stats(sender=None, **kwargs):
+    """
+    Log how many Atlas API connections this worker process has opened and reused so far.
+    """
+    stats = utilities.api_session_stats()
+    log.debug('Atlas operational statistic | API connections | Task - %s | Opened - %s | '
+              'Reused - %s', sender.name, stats['opened'], stats['reused'])
+    for operation, timing in utilities.database_stats().items():
+        log.debug('Atlas operational statistic | Database | Task - %s | %s - %s in %.3fs',
+                  sender.name, operation, timing['count'], timing['seconds'])
+
+
 class CronException(Exception):
     def __init__(self, message, errors):
 
@@ -129,12 +146,14 @@ def code_deploy(item):
     :return:
     """
     log.debug('Code deploy | %s', item)
+    clone_failed = False
     try:
-        clone = code_operations.repository_clone(item)
+        code_operations.repository_clone(item)
     except GitCommandError:
+        clone_failed = True
         log.error('Code | Clone | Cannot clone repository, check URL.')
     try:
-        checkout = code_operations.repository_checkout(item)
+        code_operations.repository_checkout(item)
     except GitCommandError:
         log.error('Code | Checkout | Cannot checkout requested tag, check value.')
     if item['meta']['is_current']:
@@ -144,9 +163,10 @@ def code_deploy(item):
     if item['meta']['code_type'] == 'static':
         code_operations.deploy_static(item)
 
-    sync = code_operations.sync_code()
+    sync_results = code_operations.sync_code([item])
+    sync_failed = not all(sync_result['success'] for sync_result in sync_results)
 
-    if clone or sync:
+    if clone_failed or sync_failed:
         text = 'Error'
         slack_color = 'danger'
     else:
@@ -190,8 +210,13 @@ def code_deploy(item):
         "user": item['created_by']
     }
 
-    if clone or sync:
-        error_json = json.dumps(clone + sync)
+    if clone_failed or sync_failed:
+        errors = {'clone_failed': clone_failed, 'sync': [
+            {'source': sync_result['source'], 'host': host, 'returncode': result['returncode'],
+             'output': result.get('output')}
+            for sync_result in sync_results for host, result in sync_result['hosts'].items()
+            if result['returncode'] != 0]}
+        error_json = json.dumps(errors)
         slack_payload['attachments'].append(
             {
                 "fallback": 'Error message',
@@ -224,6 +249,7 @@ def code_update(updated_item, original_item):
     final_item = original_item.copy()
     # updated_item has the correct meta dict
     final_item.update(updated_item)
+    instance_operations.forget_core_manifest(original_item)
 
     if (updated_item['meta']['name'] != original_item['meta']['name']) or (updated_item['meta']['version'] != original_item['meta']['version']) or (updated_item['meta']['code_type'] != original_item['meta']['code_type']):
         code_operations.repository_remove(original_item)
@@ -239,7 +265,7 @@ def code_update(updated_item, original_item):
     if final_item['meta']['code_type'] == 'static':
         code_operations.deploy_static(final_item)
 
-    sync = code_operations.sync_code()
+    sync = code_operations.sync_code([original_item, final_item])
 
     slack_title = 'Code Update - Success'
     slack_color = 'good'
@@ -292,17 +318,14 @@ def code_remove(item, other_static_assets=True):
 
     log.info('Code remove | %s', item)
     code_operations.repository_remove(item)
+    instance_operations.forget_core_manifest(item)
     if item['meta']['is_current']:
-        code_folder_current = '{0}/{1}/{2}/{2}-current'.format(
-            CODE_ROOT,
-            utilities.code_type_directory_name(item['meta']['code_type']),
-            item['meta']['name'])
-        os.unlink(code_folder_current)
+        os.unlink(code_operations.current_symlink_path(item))
 
     if item['meta']['code_type'] == 'static':
         code_operations.remove_static(item, other_static_assets)
 
-    sync = code_operations.sync_code()
+    sync = code_operations.sync_code([item])
     execute(fabric_tasks.clear_php_cache)
 
     # Slack notification
@@ -349,34 +372,32 @@ def code_heal(code_items):
     Verify code is correctly deployed.
     """
     log.info('Heal | Code | Item - %s', code_items)
-    # Setup a chord. Takes a 'group' (list of tasks that should be applied in parallel) and executes
-    # another task after the group is complete.
-    # In the second task, using .si creates an immutable signature so the return value of the
-    # previous tasks will be ignored.
-    task_group = chord((_code_heal.s(code) for code in code_items['_items']), _code_sync.si())()
+    report = code_operations.code_heal_items(code_items['_items'])
+    log.info('Heal | Code | Drift report - %s', report['drifted'])
+    # Only sync what was repaired.
+    if report['changed']:
+        repaired = [result['_id'] for result in report['drifted'] if result['repaired']]
+        _code_sync.delay([item for item in code_items['_items'] if item['_id'] in repaired])
+    return report
 
 
 @celery.task
-def _code_heal(item):
+def _code_sync(items=None):
     """
-    Sub task for code_heal. Perform actual heal operations
+    Sub task for code_heal. Sync healed code to server, all of it if no items are given.
     """
-    if not os.path.isdir(utilities.code_path(item)):
-        clone = code_operations.repository_clone(item)
-        log.debug('Code heal | Clone | %s', clone)
-    checkout = code_operations.repository_checkout(item)
-    if item['meta']['is_current']:
-        code_operations.update_symlink_current(item)
-    log.debug('Code heal | Checkout | %s', checkout)
+    sync = code_operations.sync_code(items)
+    execute(fabric_tasks.clear_php_cache)
 
 
 @celery.task
-def _code_sync():
+def code_reconcile():
     """
-    Sub task for code_heal. Sync healed code to server
+    Sync all of the code to reconcile the servers. Code tasks only sync the items they changed.
     """
     sync = code_operations.sync_code()
-    execute(fabric_tasks.clear_php_cache)
+    log.info('Code reconcile | Success - %s', all(result['success'] for result in sync))
+    return sync
 
 
 @celery.task
@@ -409,9 +430,8 @@ def site_provision(site):
         log.error('Site provision failed | Error Message | %s', error)
         raise
     # Trigger rsync
-    # ? Is a way to request a sync (w/ install chained)? Sync once when creating 5 instances
     log.info('Instance | Provision | Rsync')
-    instance_operations.sync_instances(site['sid'])
+    instance_operations.sync_instances()
     # Run install
     if site.get('install') and site['install'] is not False:
         try:
@@ -421,7 +441,7 @@ def site_provision(site):
             raise
     # Correct file permissions
     instance_operations.correct_fs_permissions(site)
-    instance_operations.sync_instances(site['sid'])
+    instance_operations.sync_instances()
 
     # Update instance record
     patch_payload = {'status': site['status'],
@@ -529,7 +549,7 @@ def site_update(site, updates, original):
                       code_to_update)
             code_query = 'where={{"_id":{{"$in":{0}}}}}'.format(json.dumps(code_to_update))
             log.debug('Site Update | ID - %s | Code query - %s', site['_id'], code_query)
-            code_items = utilities.get_eve('code', code_query)
+            code_items = utilities.get_eve('code', code_query, projection=['deploy'])
             log.debug('Site Update | ID - %s | Code query response - %s', site['_id'], code_items)
             for code in code_items['_items']:
                 if code['deploy']['registry_rebuild']:
@@ -601,11 +621,12 @@ def site_update(site, updates, original):
                 patch_payload = '{"status": "down"}'
                 # Soft delete stats when we take down an instance.
                 statistics_query = 'where={{"site":"{0}"}}'.format(site['_id'])
-                statistics = utilities.get_eve('statistics', statistics_query)
+                statistics = utilities.get_eve('statistics', statistics_query, projection=['_id'])
                 log.debug('Statistics | %s', statistics)
                 if not statistics['_meta']['total'] == 0:
                     for statistic in statistics['_items']:
-                        utilities.delete_eve('statistics', statistic['_id'])
+                        utilities.delete_eve('statistics', statistic['_id'],
+                                             etag=statistic['_etag'])
 
             elif updates['status'] == 'restore':
                 log.debug('Site update | ID - %s | Status changed to restore', site['_id'])
@@ -634,7 +655,7 @@ def site_update(site, updates, original):
     # We want to run these commands in this specific order.
     log.info('Site Update | Closing operations commands | Sync - %s | PHP Cache clear - %s | Drush rr - %s; updb - %s ; cc - %s', sync_instances, deploy_php_cache_clear, deploy_registry_rebuild, deploy_update_database, deploy_drupal_cache_clear)
     if sync_instances:
-        instance_operations.sync_instances(site['sid'])
+        instance_operations.sync_instances()
         execute(fabric_tasks.clear_php_cache)
     if deploy_php_cache_clear:
         execute(fabric_tasks.clear_php_cache)
@@ -697,11 +718,11 @@ def site_remove(site):
     log.debug('Site remove | %s', site)
     # Check if stats object exists for the site first.
     statistics_query = 'where={{"site":"{0}"}}'.format(site['_id'])
-    statistics = utilities.get_eve('statistics', statistics_query)
+    statistics = utilities.get_eve('statistics', statistics_query, projection=['_id'])
     log.debug('Statistics | %s', statistics)
     if not statistics['_meta']['total'] == 0:
         for statistic in statistics['_items']:
-            utilities.delete_eve('statistics', statistic['_id'])
+            utilities.delete_eve('statistics', statistic['_id'], etag=statistic['_etag'])
 
     try:
         log.debug('Site remove | Delete database')
@@ -716,6 +737,39 @@ def site_remove(site):
     execute(fabric_tasks.clear_php_cache)
 
 
+@celery.task
+def site_remove_batch(sites):
+    """
+    Remove many sites from the server, dropping their databases with one connection and syncing
+    once at the end. See `site_remove`.
+
+    :param sites: Items to be removed.
+    """
+    log.info('Site remove | Batch | Count - %s', len(sites))
+    # Items come from the bulk delete callback with bson ObjectIds, which json can't encode.
+    site_ids = [str(site['_id']) for site in sites]
+    statistics_query = 'where={{"site":{{"$in":{0}}}}}'.format(json.dumps(site_ids))
+    statistics = utilities.get_eve('statistics', statistics_query, projection=['_id'])
+    if not statistics['_meta']['total'] == 0:
+        utilities.bulk_delete_eve(
+            'statistics',
+            [{'_id': statistic['_id'], '_etag': statistic['_etag']}
+             for statistic in statistics['_items']])
+
+    try:
+        log.debug('Site remove | Batch | Delete databases')
+        utilities.delete_databases([site['sid'] for site in sites])
+    except Exception as error:
+        log.error('Site remove failed | Database remove failed | %s', error)
+        # Want to keep trying to remove instances even if DB remove fails.
+        pass
+
+    for site in sites:
+        instance_operations.instance_delete(site)
+    instance_operations.sync_instances()
+    execute(fabric_tasks.clear_php_cache)
+
+
 @celery.task
 def drush_prepare(drush_id, run=True):
     """
@@ -809,10 +863,8 @@ def cron(status=None):
     site_query += '}'
     log.debug('Query final | %s', site_query)
 
-    sites = utilities.get_eve('sites', site_query)
-    if not sites['_meta']['total'] == 0:
-        for site in sites['_items']:
-            cron_run.delay(site)
+    for site in utilities.iter_eve('sites', site_query):
+        cron_run.delay(site)
 
 
 @celery.task
@@ -834,7 +886,8 @@ def cron_run(site):
     command = 'drush elysia-cron run --uri={1}'.format(WEBSERVER_USER, uri)
     try:
         execute(fabric_tasks.command_run_single, site=site, command=command)
-        instance_operations.correct_fs_permissions(site)
+        # Cron may have written new files, fix them later instead of walking the tree now.
+        instance_operations.queue_permissions_fix(site)
     except CronException as error:
         log.error('Site - %s | Cron failed | Error - %s', site['sid'], error)
         raise
@@ -849,7 +902,7 @@ def available_sites_check():
     Check to see how many instances we have ready to be handed out and add some more if needed.
     """
     site_query = 'where={"status":{"$in":["pending","available"]}}'
-    sites = utilities.get_eve('sites', site_query)
+    sites = utilities.get_eve('sites', site_query, projection=['_id'])
     actual_site_count = sites['_meta']['total']
     if actual_site_count < DESIRED_SITE_COUNT:
         needed_sites_count = DESIRED_SITE_COUNT - actual_site_count
@@ -867,10 +920,11 @@ def delete_stuck_pending_sites():
     Task to delete pending sites that don't provision correctly for some reason.
     """
     site_query = 'where={"status":"pending"}'
-    sites = utilities.get_eve('sites', site_query)
+    sites = utilities.get_eve('sites', site_query, projection=['sid'])
     log.debug('Sites - %s', sites)
     # Loop through and remove sites that are more than 15 minutes old.
     if not sites['_meta']['total'] == 0:
+        stuck_sites = []
         for site in sites['_items']:
             # Parse date string into structured datetime.
             # See https://docs.python.org/2/library/datetime.html#strftime-and-strptime-behavior
@@ -882,7 +936,9 @@ def delete_stuck_pending_sites():
             log.debug('%s has timedelta of %s. Created: %s Current: %s',
                       site['sid'], time_since_creation, date_created, datetime.utcnow())
             if time_since_creation > timedelta(minutes=20):
-                utilities.delete_eve('sites', site['_id'])
+                stuck_sites.append({'_id': site['_id'], '_etag': site['_etag']})
+        if stuck_sites:
+            utilities.bulk_delete_eve('sites', stuck_sites)
 
 
 @celery.task
@@ -891,12 +947,11 @@ def delete_all_available_sites():
     Get a list of available sites and delete them.
     """
     site_query = 'where={"status":"available"}'
-    sites = utilities.get_eve('sites', site_query)
+    sites = utilities.get_eve('sites', site_query, projection=['_id'])
     log.debug('Sites - %s', sites)
     if not sites['_meta']['total'] == 0:
-        for site in sites['_items']:
-            log.debug('Site - %s', site)
-            utilities.delete_eve('sites', site['_id'])
+        utilities.bulk_delete_eve(
+            'sites', [{'_id': site['_id'], '_etag': site['_etag']} for site in sites['_items']])
 
 
 @celery.task
@@ -907,7 +962,7 @@ def remove_unused_code():
     time_ago = datetime.utcnow() - timedelta(days=90)
     code_query = 'where={{"meta.is_current":false,"_created":{{"$lte":"{0}"}}}}'.format(
         time_ago.strftime("%Y-%m-%d %H:%M:%S GMT"))
-    code_items = utilities.get_eve('code', code_query)
+    code_items = utilities.get_eve('code', code_query, projection=['meta.code_type'])
 
     for code in code_items['_items']:
         # Check for sites using this piece of code.
@@ -917,11 +972,11 @@ def remove_unused_code():
             code_type = code['meta']['code_type']
         log.debug('code - %s | code_type - %s', code['_id'], code_type)
         site_query = 'where={{"code.{0}":"{1}"}}'.format(code_type, code['_id'])
-        sites = utilities.get_eve('sites', site_query)
+        sites = utilities.get_eve('sites', site_query, projection=['_id'])
         log.debug('Delete | code - %s | sites result - %s', code['_id'], sites)
         if sites['_meta']['total'] == 0:
             log.info('Removing unused item | code - %s', code['_id'])
-            utilities.delete_eve('code', code['_id'])
+            utilities.delete_eve('code', code['_id'], etag=code['_etag'])
 
 
 @celery.task
@@ -929,21 +984,16 @@ def remove_orphan_statistics():
     """
     Get a list of statistics and key them against a list of active instances.
     """
-    sites = utilities.get_eve('sites')
-    statistics = utilities.get_eve('statistics')
-    log.debug('Statistics | %s', statistics)
-    log.debug('Sites | %s', sites)
-    site_id_list = []
-    # Make as list of ids for easy checking.
-    if not statistics['_meta']['total'] == 0:
-        if not sites['_meta']['total'] == 0:
-            for site in sites['_items']:
-                site_id_list.append(site['_id'])
-                log.debug('Sites list | %s', site_id_list)
-        for statistic in statistics['_items']:
-            if statistic['site'] not in site_id_list:
-                log.info('Statistic not in list | %s', statistic['_id'])
-                utilities.delete_eve('statistics', statistic['_id'])
+    # Make a set of ids for easy checking.
+    site_ids = set(site['_id'] for site in utilities.iter_eve('sites', projection=['_id']))
+    log.debug('Sites list | %s', site_ids)
+    # Collect the orphans before deleting, removing items while paging would shift later pages.
+    orphans = [{'_id': statistic['_id'], '_etag': statistic['_etag']}
+               for statistic in utilities.iter_eve('statistics', projection=['site'])
+               if statistic['site'] not in site_ids]
+    log.info('Statistics not in list | %s', [orphan['_id'] for orphan in orphans])
+    if orphans:
+        utilities.bulk_delete_eve('statistics', orphans)
 
 
 @celery.task
@@ -953,7 +1003,7 @@ def take_down_installed_old_sites():
     """
     if ENVIRONMENT in ['dev', 'test']:
         site_query = 'where={"status":"installed"}'
-        sites = utilities.get_eve('sites', site_query)
+        sites = utilities.get_eve('sites', site_query, projection=['sid'])
         # Loop through and remove sites that are more than 35 days old.
         for site in sites['_items']:
             # Parse date string into structured time.
@@ -969,7 +1019,7 @@ def take_down_installed_old_sites():
             if seconds_since_creation > 3024000:
                 # Patch the status to 'take_down'.
                 payload = {'status': 'take_down'}
-                utilities.patch_eve('sites', site['_id'], payload)
+                utilities.patch_eve('sites', site['_id'], payload, etag=site['_etag'])
 
 
 @celery.task
@@ -980,7 +1030,7 @@ def verify_statistics():
     time_ago = datetime.utcnow() - timedelta(hours=36)
     statistics_query = 'where={{"_updated":{{"$lte":"{0}"}}}}'.format(
         time_ago.strftime("%Y-%m-%d %H:%M:%S GMT"))
-    outdated_statistics = utilities.get_eve('statistics', statistics_query)
+    outdated_statistics = utilities.get_eve('statistics', statistics_query, projection=['_id'])
     log.debug('Old statistics time - %s', time_ago.strftime("%Y-%m-%d %H:%M:%S GMT"))
     log.debug('outdated_statistics items - %s', outdated_statistics)
     statistic_id_list = []
@@ -992,7 +1042,7 @@ def verify_statistics():
 
         site_query = 'where={{"statistics":{{"$in":{0}}}}}'.format(json.dumps(statistic_id_list))
         log.debug('Site query | %s', site_query)
-        sites = utilities.get_eve('sites', site_query)
+        sites = utilities.get_eve('sites', site_query, projection=['sid'])
         sites_id_list = []
         if not sites['_meta']['total'] == 0:
             log.info('More than 0 sites')
@@ -1056,7 +1106,8 @@ def backup_instances_all(backup_type='routine'):
     log.info('Backup all instances')
     # Get the instance IDs for excluded paths
     exclude_instances = utilities.get_eve(
-        'sites', 'where={{"path":{{"$in":{0}}}}}'.format(json.dumps(BACKUPS_LARGE_INSTANCES)))
+        'sites', 'where={{"path":{{"$in":{0}}}}}'.format(json.dumps(BACKUPS_LARGE_INSTANCES)),
+        projection=['_id'])
     log.debug('Backup all instances | Exclude instances - %s', exclude_instances['_items'])
     exclude_ids = []
     for instance in exclude_instances['_items']:
@@ -1067,7 +1118,7 @@ def backup_instances_all(backup_type='routine'):
         json.dumps(exclude_ids))
     log.debug('Backup all instances | Stats query - %s', statistics_query)
     statistics = utilities.get_eve(
-        'statistics', statistics_query)
+        'statistics', statistics_query, projection=['site'])
     batch_id = time.time()
     if not statistics['_meta']['total'] == 0:
         for statistic in statistics['_items']:
@@ -1108,17 +1159,17 @@ def backup_instances_large(backup_type='routine'):
     log.info('Backup large instances')
     # Get the instance IDs for include paths
     instances = utilities.get_eve('sites', 'where={{"path":{{"$in":[{0}]}}}}'.format(
-        json.dumps(BACKUPS_LARGE_INSTANCES)))
+        json.dumps(BACKUPS_LARGE_INSTANCES)), projection=['_id'])
     log.debug('Backup large instances | Include instances - %s', instances['_items'])
     instances_ids = []
-    for instance in instances_instances['_items']:
+    for instance in instances['_items']:
         instances_ids.append(instance['_id'])
     log.debug('Backup large instances | List of IDs to include - %s', instances_ids)
     statistics_query = 'where={{"status":{{"$in":["installed","launched"]}},"days_since_last_edit":{{"$lte":7}},"site":{{"$in":[{0}]}}}}'.format(
         json.dumps(instances_ids))
     log.debug('Backup large instances | Stats query - %s', statistics_query)
     statistics = utilities.get_eve(
-        'statistics', statistics_query)
+        'statistics', statistics_query, projection=['site'])
     batch_id = time.time()
     if not statistics['_meta']['total'] == 0:
         for statistic in statistics['_items']:
@@ -1172,6 +1223,27 @@ def backup_remove(item):
     log.info('Backup | Delete | Item - %s | Delete finished', item['_id'])
 
 
+@celery.task
+def backup_remove_batch(items):
+    """
+    Remove the files for many backups, used after a bulk delete. A backup that fails is logged
+    and the rest of the batch is still removed.
+
+    :param items: List of backup items
+    """
+    log.info('Backup | Delete | Batch | Count - %s', len(items))
+    failed = []
+    for item in items:
+        try:
+            backup_remove(item)
+        except Exception as error:
+            log.error('Backup | Delete | Batch | Item - %s | Error - %s', item['_id'], error)
+            failed.append(item['_id'])
+    if failed:
+        log.error('Backup | Delete | Batch | Failed - %s of %s | Items - %s',
+                  len(failed), len(items), failed)
+
+
 @celery.task
 def remove_old_backups():
     """
@@ -1180,18 +1252,24 @@ def remove_old_backups():
     time_ago = datetime.utcnow() - timedelta(days=90)
     backup_query = 'where={{"_created":{{"$lte":"{0}"}}}}'.format(
         time_ago.strftime("%Y-%m-%d %H:%M:%S GMT"))
-    backups = utilities.get_eve('backup', backup_query)
+    backups = utilities.get_eve('backup', backup_query, projection=['site'])
     # Loop through and remove backups that are old.
     if not backups['_meta']['total'] == 0:
+        # Count every backup per instance once, then keep count as we mark old ones for removal so
+        # that we never remove the last backup for an instance.
+        remaining = Counter(backup['site'] for backup in utilities.iter_eve(
+            'backup', projection=['site']))
+        old_backups = []
         for backup in backups['_items']:
-            check_for_other = utilities.get_eve(
-                'backup', 'where={{"site":"{0}"}}'.format(backup['site']))
-            if not check_for_other['_meta']['total'] == 1:
+            if remaining[backup['site']] > 1:
                 log.info('Delete old backup | backup - %s', backup)
-                utilities.delete_eve('backup', backup['_id'])
+                old_backups.append({'_id': backup['_id'], '_etag': backup['_etag']})
+                remaining[backup['site']] -= 1
             else:
                 log.info('Backups | Will not remove old backup, it is the only one | Backup - %s | Site %s',
                          backup['_id'], backup['site'])
+        if old_backups:
+            utilities.bulk_delete_eve('backup', old_backups)
 
 
 @celery.task
@@ -1199,7 +1277,7 @@ def remove_extra_backups():
     """
     Delete extra backups, we only want to keep 5 per instance.
     """
-    backup_data = utilities.get_eve('backup')
+    backup_data = utilities.get_eve('backup', projection=['site'])
     log.debug('Delete extra backups | backup_data - %s', backup_data)
     instance_ids = []
     for item in backup_data['_items']:
@@ -1211,10 +1289,12 @@ def remove_extra_backups():
     high_count = {k: v for (k, v) in counts.items() if v > 5}
     log.info('Delete extra backups | High Count - %s', high_count)
     if high_count:
+        extra_backups = []
         for item in high_count:
             # Get a list of backups for this instance, sorted by age (oldest first)
             instance_backup_query = 'where={{"site":"{0}"}}&sort=[("_created",1)]'.format(item)
-            instance_backups = utilities.get_eve('backup', instance_backup_query)
+            instance_backups = utilities.get_eve(
+                'backup', instance_backup_query, projection=['_id'])
             log.info('Delete extra backups | List of backups - %s', instance_backups)
             # Remove the oldest
             backup_count = instance_backups['_meta']['total']
@@ -1222,8 +1302,10 @@ def remove_extra_backups():
                 if backup_count > 5:
                     log.info('Delete extra backups | Backup count - %s', backup_count)
                     log.info('Delete extra backup | Backup to remove - %s', back_to_remove['_id'])
-                    utilities.delete_eve('backup', back_to_remove['_id'])
+                    extra_backups.append(
+                        {'_id': back_to_remove['_id'], '_etag': back_to_remove['_etag']})
                     backup_count -= 1
+        utilities.bulk_delete_eve('backup', extra_backups)
 
 
 @celery.task
@@ -1235,9 +1317,10 @@ def remove_failed_backups():
     time_ago = datetime.utcnow() - timedelta(minutes=90)
     backup_query = 'where={{"state":"pending","_created":{{"$lte":"{0}"}}}}'.format(
         time_ago.strftime("%Y-%m-%d %H:%M:%S GMT"))
-    backups = utilities.get_eve('backup', backup_query)
-    for item in backups['_items']:
-        utilities.delete_eve('backup', item['_id'])
+    backups = utilities.get_eve('backup', backup_query, projection=['_id'])
+    if not backups['_meta']['total'] == 0:
+        utilities.bulk_delete_eve(
+            'backup', [{'_id': item['_id'], '_etag': item['_etag']} for item in backups['_items']])
 
 
 @celery.task
@@ -1248,7 +1331,7 @@ def report_routine_backups():
     time_ago = datetime.utcnow() - timedelta(hours=24)
     query = 'where={{"state":"complete","backup_type":"routine","_created":{{"$gte":"{0}"}}}}'.format(
         time_ago.strftime("%Y-%m-%d %H:%M:%S GMT"))
-    backups = utilities.get_eve('backup', query)
+    backups = utilities.get_eve('backup', query, projection=['_id'])
     log.info('Atlas operational statistic | Complete routine backups in last 24 hours - %s',
              backups['_meta']['total'])
 
@@ -1327,30 +1410,35 @@ def rebalance_update_groups():
     """
     log.info
     installed_query = 'where={"status":"installed"}'
-    installed_sites = utilities.get_eve('sites', installed_query)
+    installed_sites = utilities.get_eve('sites', installed_query, projection=['_id'])
     launched_query = 'where={"status":"launched"}'
-    launched_sites = utilities.get_eve('sites', launched_query)
+    launched_sites = utilities.get_eve('sites', launched_query, projection=['update_group'])
     installed_update_group = 0
     launched_update_group = 0
+    patches = []
     if not installed_sites['_meta']['total'] == 0:
         for site in installed_sites['_items']:
-            patch_payload = '{{"update_group": {0}}}'.format(installed_update_group)
+            patch_payload = {'update_group': installed_update_group}
             if installed_update_group < 2:
                 installed_update_group += 1
             else:
                 installed_update_group = 0
-            utilities.patch_eve('sites', site['_id'], patch_payload)
+            patches.append({'_id': site['_id'], '_etag': site['_etag'], 'updates': patch_payload})
 
     if not launched_sites['_meta']['total'] == 0:
         for site in launched_sites['_items']:
             # Only update if the group is less than 6.
             if site['update_group'] < 6:
-                patch_payload = '{{"update_group": {0}}}'.format(launched_update_group)
+                patch_payload = {'update_group': launched_update_group}
                 if launched_update_group < 5:
                     launched_update_group += 1
                 else:
                     launched_update_group = 0
-                utilities.patch_eve('sites', site['_id'], patch_payload)
+                patches.append(
+                    {'_id': site['_id'], '_etag': site['_etag'], 'updates': patch_payload})
+
+    if patches:
+        utilities.bulk_patch_eve('sites', patches)
 
 
 @celery.task
@@ -1365,7 +1453,7 @@ def update_settings_file(site, batch_id, count, total):
         log.error('Command | Update Settings file | Batch - %s | %s of %s | Instance - %s | Error - %s',
                   batch_id, count, total, site, error)
         raise
-    instance_operations.sync_instances(site['sid'])
+    instance_operations.sync_instances()
     execute(fabric_tasks.clear_php_cache)
 
 
@@ -1402,19 +1490,24 @@ def _instance_heal(instance):
     """
     log.info('Heal | Instance | Instance - %s', instance['_id'])
     log.debug('Heal | Instance | Instance - %s', instance)
-    # We are not removing the DB or user uploaded files during heal.
-    instance_operations.instance_delete(instance, nfs_preserve=True)
-    instance_operations.instance_create(instance, nfs_preserve=True)
+    # We are not touching the DB or user uploaded files during heal. Only the symlinks and files
+    # that differ from what the instance should have are changed.
+    changes = instance_operations.apply_layout(instance)
+    instance_operations.switch_settings_files(instance)
+    # A full pass, files changed outside of Atlas don't change their directory's mtime.
+    instance_operations.correct_fs_permissions(instance)
+    return changes
 
 
 @celery.task
-def instance_sync():
+def instance_sync(full=False):
     """
-    Sub task for instance_heal. Sync healed instances to server
+    Sub task for instance_heal. Sync healed instances to server. With `full`, sync all of the
+    instance files to reconcile the servers.
     """
     # Update homepage files.
     instance_operations.switch_homepage_files()
-    instance_operations.sync_instances()
+    instance_operations.sync_instances(full=full)
     execute(fabric_tasks.clear_php_cache)
 
 
@@ -1431,6 +1524,39 @@ def correct_file_permissions(instance):
         raise
 
 
+@celery.task(soft_time_limit=PERMISSIONS_BULK_TIME_LIMIT,
+             time_limit=PERMISSIONS_BULK_TIME_LIMIT + 60)
+def correct_file_permissions_bulk(instances, incremental=False):
+    """
+    Correct file permissions for many instances at once, see
+    `instance_operations.correct_fs_permissions_bulk`. Instances that are not started in time are
+    skipped and reported.
+    """
+    log.info('Correct file permissions | Bulk | Count - %s', len(instances))
+    try:
+        report = instance_operations.correct_fs_permissions_bulk(
+            instances, incremental=incremental, stop_after=PERMISSIONS_BULK_STOP_AFTER)
+    except SoftTimeLimitExceeded:
+        # A walk that was already running took too long, the counts for the batch are lost.
+        log.error('Correct file permissions | Bulk | Time limit exceeded | Instances - %s',
+                  [instance['sid'] for instance in instances])
+        return {'instances': {}, 'failed': len(instances), 'error': 'Time limit exceeded'}
+    for sid, counts in report['instances'].items():
+        log.debug('Correct file permissions | Bulk | Instance - %s | %s', sid, counts)
+    return report
+
+
+@celery.task(time_limit=PERMISSIONS_QUEUE_TIME_LIMIT)
+def correct_queued_file_permissions():
+    """
+    Correct file permissions for instances that cron has run on since the last pass.
+    """
+    report = instance_operations.drain_permissions_queue(limit=PERMISSIONS_QUEUE_LIMIT)
+    log.info('Atlas operational statistic | Queued permissions | Instances - %s | Changed - %s',
+             len(report['instances']), report['changed'])
+    return report
+
+
 @celery.task(time_limit=2000)
 def import_backup(env, backup_id, target_instance):
     """Download and import a backup
@@ -7,12 +7,20 @@ import logging
 import json
 import subprocess
 import stat
+import tempfile
 import smtplib
 import re
+import threading
+import time
+import hmac
+from collections import deque, OrderedDict
+from copy import deepcopy
+from itertools import islice
 from math import ceil
+from multiprocessing.pool import ThreadPool
 from random import choice
 from string import lowercase
-from hashlib import sha1
+from hashlib import sha1, sha256
 from email.mime.text import MIMEText
 
 from cryptography.fernet import Fernet
@@ -20,8 +28,11 @@ from eve.auth import BasicAuth
 from flask import g
 import OpenSSL
 import mysql.connector as mariadb
+from mysql.connector import pooling as mariadb_pooling
 import requests
 import ldap
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from atlas.config import (ATLAS_LOCATION, ALLOWED_USERS, LDAP_SERVER, LDAP_ORG_UNIT,
                           LDAP_DNS_DOMAIN_NAME, ENCRYPTION_KEY, DATABASE_USER,
@@ -30,17 +41,147 @@ from atlas.config import (ATLAS_LOCATION, ALLOWED_USERS, LDAP_SERVER, LDAP_ORG_U
                           SLACK_USERNAME, SLACK_URL, SEND_NOTIFICATION_EMAILS,
                           SEND_NOTIFICATION_FROM_EMAIL, EMAIL_HOST, EMAIL_PORT, EMAIL_USERNAME,
                           EMAIL_PASSWORD, EMAIL_USERS_EXCLUDE, SAML_AUTH, CODE_ROOT,
-                          INSTANCE_CODE_IGNORE_REGEX)
+                          INSTANCE_CODE_IGNORE_REGEX, API_POOL_CONNECTIONS, API_POOL_MAXSIZE,
+                          API_RETRIES, API_RETRY_BACKOFF_FACTOR, API_RETRY_STATUS_CODES,
+                          API_TIMEOUT, API_PAGE_CONCURRENCY, API_CACHE_RESOURCES, API_CACHE_SIZE,
+                          API_CACHE_TTL, API_PRECONDITION_RETRIES, BULK_BATCH_SIZE,
+                          LDAP_AUTH_CACHE_TTL, LDAP_AUTH_CACHE_FAILURE_TTL, LDAP_AUTH_CACHE_SIZE,
+                          LDAP_PERSISTENT_CONNECTION, LDAP_TIMEOUT, DATABASE_POOL_SIZE,
+                          SYNC_MAX_WORKERS, CODE_STORE_ROOT)
 from atlas.config_servers import (SERVERDEFS, API_URLS)
 from atlas.data_structure import PAGINATION_DEFAULT
 
 # Setup a sub-logger. See tasks.py for longer comment.
 log = logging.getLogger('atlas.utilities')
 
+# Read the bytes sent from the output of `rsync --stats`.
+RSYNC_BYTES_SENT = re.compile(r'Total bytes sent: ([\d,]+)')
+# Join all INSTANCE_CODE_IGNORE_REGEX expressions into a single expression with the pipe seperator.
+# We use '?:' since we don't care which expression matches. Multiline modifier: ^ and $ to match
+# the begin/end of each line (not only begin/end of string). See `ignore_code_file`.
+CODE_IGNORE_MATCHER = re.compile('(?:%s)' % '|'.join(INSTANCE_CODE_IGNORE_REGEX), re.MULTILINE)
+
 
 if ATLAS_LOCATION not in sys.path:
     sys.path.append(ATLAS_LOCATION)
 
+# Process local session for calls to the Atlas API. Celery workers and WSGI processes fork after
+# this module is imported, so we remember which PID built the session and build a new one in each
+# child instead of sharing sockets across processes.
+_API_SESSION = {'pid': None, 'session': None}
+_API_SESSION_LOCK = threading.Lock()
+
+# LRU cache of single items from the Atlas API, see `get_single_eve`. Keyed on
+# (env, resource, id, version, url) and holds (time validated, record).
+_API_CACHE = OrderedDict()
+_API_CACHE_LOCK = threading.Lock()
+
+# Results of recent LDAP binds, see `AtlasBasicAuth`. Keyed on an HMAC of the username and password
+# with a random per process salt, so plain credentials never sit in memory as dict keys. Holds
+# (expires, result).
+_LDAP_AUTH_CACHE = {}
+_LDAP_AUTH_CACHE_SALT = os.urandom(32)
+_LDAP_AUTH_CACHE_LOCK = threading.Lock()
+# Persistent LDAP connection, see `ldap_bind`. Binds on a shared connection have to be serialized.
+_LDAP_CONNECTION = {'pid': None, 'connection': None}
+_LDAP_CONNECTION_LOCK = threading.Lock()
+# Process local pool of connections to the master database server, see `database_connection`.
+_DATABASE_POOL = {'pid': None, 'pool': None}
+_DATABASE_POOL_LOCK = threading.Lock()
+# Count and total seconds for each kind of database operation in this process, see
+# `database_stats`.
+_DATABASE_STATS = {}
+_DATABASE_STATS_LOCK = threading.Lock()
+
+def ldap_connection():
+    """
+    Get a new LDAP connection.
+    """
+    # Initialize LDAP. The initialize() method returns an LDAPObject object, which contains
+    # methods for performing LDAP operations and retrieving information about the LDAP
+    # connection and transactions.
+    connection = ldap.initialize(LDAP_SERVER)
+    connection.set_option(ldap.OPT_NETWORK_TIMEOUT, LDAP_TIMEOUT)
+    connection.set_option(ldap.OPT_TIMEOUT, LDAP_TIMEOUT)
+    return connection
+
+
+def ldap_bind(distinguished_name, password):
+    """
+    Bind to LDAP with the given credentials. Raises `ldap.INVALID_CREDENTIALS` for a bad login.
+
+    With `LDAP_PERSISTENT_CONNECTION` we keep one connection per process and rebind it for each
+    login, reconnecting once if the server dropped it. Otherwise we open and close a connection
+    for every bind.
+
+    :param distinguished_name:
+    :param password:
+    """
+    if not LDAP_PERSISTENT_CONNECTION:
+        l = ldap_connection()
+        try:
+            # Try a synchronous bind (we want synchronous so that the command is blocked until the
+            # bind gets a result. If you can bind, the credentials are valid.
+            l.simple_bind_s(distinguished_name, password)
+        finally:
+            try:
+                log.debug('LDAP | unbind')
+                l.unbind()
+            except ldap.LDAPError:
+                log.error('LDAP | unbind failed')
+        return
+
+    with _LDAP_CONNECTION_LOCK:
+        if _LDAP_CONNECTION['pid'] != os.getpid() or _LDAP_CONNECTION['connection'] is None:
+            log.debug('LDAP | Persistent connection | Connect | PID - %s', os.getpid())
+            _LDAP_CONNECTION['connection'] = ldap_connection()
+            _LDAP_CONNECTION['pid'] = os.getpid()
+        try:
+            _LDAP_CONNECTION['connection'].simple_bind_s(distinguished_name, password)
+        except ldap.SERVER_DOWN:
+            log.info('LDAP | Persistent connection | Server down, reconnecting')
+            _LDAP_CONNECTION['connection'] = ldap_connection()
+            _LDAP_CONNECTION['connection'].simple_bind_s(distinguished_name, password)
+
+
+def ldap_auth_cache_key(username, password):
+    """
+    Key for the LDAP auth cache.
+    """
+    digest = hmac.new(_LDAP_AUTH_CACHE_SALT, digestmod=sha256)
+    for value in [username, password]:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        digest.update(value + '\0')
+    return digest.hexdigest()
+
+
+def ldap_auth_cache_get(key):
+    """
+    Get a cached bind result, or None if there isn't a fresh one.
+    """
+    with _LDAP_AUTH_CACHE_LOCK:
+        cached = _LDAP_AUTH_CACHE.get(key)
+    if cached and cached[0] > time.time():
+        return cached[1]
+    return None
+
+
+def ldap_auth_cache_set(key, result):
+    """
+    Remember a bind result. Failures are kept for a shorter time so that a fixed password works
+    quickly.
+    """
+    now = time.time()
+    ttl = LDAP_AUTH_CACHE_TTL if result else LDAP_AUTH_CACHE_FAILURE_TTL
+    with _LDAP_AUTH_CACHE_LOCK:
+        if len(_LDAP_AUTH_CACHE) >= LDAP_AUTH_CACHE_SIZE:
+            for expired in [k for k, v in _LDAP_AUTH_CACHE.items() if v[0] <= now]:
+                del _LDAP_AUTH_CACHE[expired]
+            if len(_LDAP_AUTH_CACHE) >= LDAP_AUTH_CACHE_SIZE:
+                _LDAP_AUTH_CACHE.clear()
+        _LDAP_AUTH_CACHE[key] = (now + ttl, result)
+
 
 class AtlasBasicAuth(BasicAuth):
     """
@@ -48,41 +189,38 @@ class AtlasBasicAuth(BasicAuth):
     """
     def check_auth(self, username, password, allowed_roles=['default'], resource='default', method='default'):
         """
-        Check user supplied credentials against LDAP.
+        Check user supplied credentials against LDAP. Results are cached for a short time so that
+        repeated requests, like the ones from Celery with the service account, don't bind every
+        time.
         """
         # Check if username is in 'allowed users' defined in config_local.py
         if username not in ALLOWED_USERS:
             return False
-        # Initialize LDAP. The initialize() method returns an LDAPObject object, which contains
-        # methods for performing LDAP operations and retrieving information about the LDAP
-        # connection and transactions.
-        l = ldap.initialize(LDAP_SERVER)
+
+        # Add the username as a Flask application global.
+        g.username = username
+
+        cache_key = ldap_auth_cache_key(username, password)
+        cached = ldap_auth_cache_get(cache_key)
+        if cached is not None:
+            log.debug('LDAP | %s | Cached result - %s', username, cached)
+            return cached
 
         ldap_distinguished_name = "uid={0},ou={1},{2}".format(
             username, LDAP_ORG_UNIT, LDAP_DNS_DOMAIN_NAME)
         log.debug(ldap_distinguished_name)
 
-        # Add the username as a Flask application global.
-        g.username = username
-
         try:
-            # Try a synchronous bind (we want synchronous so that the command is blocked until the
-            # bind gets a result. If you can bind, the credentials are valid.
-            l.simple_bind_s(ldap_distinguished_name, password)
+            ldap_bind(ldap_distinguished_name, password)
             log.debug('LDAP | %s | Bind successful', username)
+            ldap_auth_cache_set(cache_key, True)
             return True
         except ldap.INVALID_CREDENTIALS:
             log.debug('LDAP | %s | Invalid credentials', username)
-        finally:
-            try:
-                log.debug('LDAP | unbind')
-                l.unbind()
-            except ldap.LDAPError, e:
-                log.error('LDAP | unbind failed')
-                pass
 
         # Apparently this was a bad login attempt
         log.info('LDAP | %s | Bind failed', username)
+        ldap_auth_cache_set(cache_key, False)
         return False
 
 
@@ -127,48 +265,164 @@ def decrypt_string(string):
     return decrypted
 
 
+def record_database_timing(operation, seconds):
+    """
+    Add the time taken by a database operation to the process stats.
+    """
+    with _DATABASE_STATS_LOCK:
+        stats = _DATABASE_STATS.setdefault(operation, {'count': 0, 'seconds': 0.0})
+        stats['count'] += 1
+        stats['seconds'] += seconds
+
+
+def database_stats():
+    """
+    Report the count and total time of each database operation in this process.
+
+    :return: dict of operation to {'count': int, 'seconds': float}
+    """
+    with _DATABASE_STATS_LOCK:
+        return deepcopy(_DATABASE_STATS)
+
+
+def database_config():
+    """
+    Connection settings for the master database server.
+    """
+    return {
+        'user': DATABASE_USER,
+        'password': DATABASE_PASSWORD,
+        'host': SERVERDEFS[ENVIRONMENT]['database_servers']['master'],
+        'port': SERVERDEFS[ENVIRONMENT]['database_servers']['port'],
+    }
+
+
+def database_connection():
+    """
+    Get a connection to the master database server from the process local pool. Closing the
+    connection returns it to the pool. If every pooled connection is in use, open a new one.
+    """
+    pid = os.getpid()
+    if _DATABASE_POOL['pid'] != pid:
+        with _DATABASE_POOL_LOCK:
+            if _DATABASE_POOL['pid'] != pid:
+                log.debug('Utilities | Database pool | New pool | PID - %s', pid)
+                _DATABASE_POOL['pool'] = mariadb_pooling.MySQLConnectionPool(
+                    pool_name='atlas_{0}'.format(pid),
+                    pool_size=DATABASE_POOL_SIZE,
+                    pool_reset_session=True,
+                    **database_config())
+                _DATABASE_POOL['pid'] = pid
+    start_time = time.time()
+    try:
+        connection = _DATABASE_POOL['pool'].get_connection()
+    except mariadb.errors.PoolError:
+        log.info('Utilities | Database pool | Pool exhausted, opening a new connection')
+        connection = mariadb.connect(**database_config())
+    record_database_timing('connect', time.time() - start_time)
+    return connection
+
+
+def database_execute(cursor, operation, statement):
+    """
+    Execute a statement and record how long it took.
+
+    :param cursor:
+    :param operation: Name to record the timing under
+    :param statement: SQL to execute
+    """
+    start_time = time.time()
+    try:
+        cursor.execute(statement)
+    finally:
+        record_database_timing(operation, time.time() - start_time)
+
+
+def create_databases(instances):
+    """
+    Create a database and user for each instance, using one connection for the batch.
+
+    :param instances: list of (sid, db_key) tuples
+    """
+    log.info('Create Database | Batch | %s', [site_sid for site_sid, site_db_key in instances])
+    mariadb_connection = database_connection()
+    cursor = mariadb_connection.cursor()
+    try:
+        for site_sid, site_db_key in instances:
+            # Create database
+            try:
+                database_execute(cursor, 'create_database',
+                                 "CREATE DATABASE IF NOT EXISTS `{0}`;".format(site_sid))
+            except mariadb.Error as error:
+                log.error('Create Database | %s | %s', site_sid, error)
+                raise
+
+            instance_database_password = decrypt_string(site_db_key)
+            # Grant privileges/add user
+            try:
+                if ENVIRONMENT != 'local':
+                    database_execute(
+                        cursor, 'grant',
+                        "GRANT ALL PRIVILEGES ON {0}.* TO '{0}'@'{1}' IDENTIFIED BY '{2}';".format(
+                            site_sid,
+                            SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern'],
+                            instance_database_password))
+                else:
+                    database_execute(
+                        cursor, 'grant',
+                        "GRANT ALL PRIVILEGES ON {0}.* TO '{0}'@'localhost' "
+                        "IDENTIFIED BY '{1}';".format(site_sid, instance_database_password))
+            except mariadb.Error as error:
+                log.error('Grant Privileges | %s | %s', site_sid, error)
+                raise
+            log.info('Create Database | %s | Success', site_sid)
+
+        mariadb_connection.commit()
+    finally:
+        cursor.close()
+        mariadb_connection.close()
+
+
 def create_database(site_sid, site_db_key):
     """
     Create a database and user for the
     :param site: site object
     """
     log.info('Create Database | %s', site_sid)
-    # Start connection
-    mariadb_connection = mariadb.connect(
-        user=DATABASE_USER,
-        password=DATABASE_PASSWORD,
-        host=SERVERDEFS[ENVIRONMENT]['database_servers']['master'],
-        port=SERVERDEFS[ENVIRONMENT]['database_servers']['port']
-    )
+    create_databases([(site_sid, site_db_key)])
 
-    cursor = mariadb_connection.cursor()
 
-    # Create database
-    try:
-        cursor.execute("CREATE DATABASE IF NOT EXISTS `{0}`;".format(site_sid))
-    except mariadb.Error as error:
-        log.error('Create Database | %s | %s', site_sid, error)
-        raise
+def delete_databases(site_sids):
+    """
+    Delete the database and user for each instance, using one connection for the batch.
 
-    instance_database_password = decrypt_string(site_db_key)
-    # Grant privileges/add user
+    :param site_sids: list of SIDs for instances to remove.
+    """
+    log.info('Delete Database | Batch | %s', site_sids)
+    mariadb_connection = database_connection()
+    cursor = mariadb_connection.cursor()
     try:
-        if ENVIRONMENT != 'local':
-            cursor.execute("GRANT ALL PRIVILEGES ON {0}.* TO '{0}'@'{1}' IDENTIFIED BY '{2}';".format(
-                site_sid,
-                SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern'],
-                instance_database_password))
-        else:
-            cursor.execute("GRANT ALL PRIVILEGES ON {0}.* TO '{0}'@'localhost' IDENTIFIED BY '{1}';".format(
-                site_sid, instance_database_password))
-    except mariadb.Error as error:
-        log.error('Grant Privileges | %s | %s', site_sid, error)
-        raise
+        for site_sid in site_sids:
+            # Drop database
+            try:
+                database_execute(cursor, 'drop_database',
+                                 "DROP DATABASE IF EXISTS `{0}`;".format(site_sid))
+            except mariadb.Error as error:
+                log.error('Drop Database | %s | %s', site_sid, error)
 
-    mariadb_connection.commit()
-    mariadb_connection.close()
+            # Drop user
+            try:
+                database_execute(cursor, 'drop_user', "DROP USER '{0}'@'{1}';".format(
+                    site_sid,
+                    SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern']))
+            except mariadb.Error as error:
+                log.error('Drop User | %s | %s', site_sid, error)
+            log.info('Delete Database | %s | Success', site_sid)
 
-    log.info('Create Database | %s | Success', site_sid)
+        mariadb_connection.commit()
+    finally:
+        cursor.close()
+        mariadb_connection.close()
 
 
 def delete_database(site_sid):
@@ -178,32 +432,75 @@ def delete_database(site_sid):
     :param site_id: SID for instance to remove.
     """
     log.info('Delete Database | %s', site_sid)
-    # Start connection
-    mariadb_connection = mariadb.connect(
-        user=DATABASE_USER,
-        password=DATABASE_PASSWORD,
-        host=SERVERDEFS[ENVIRONMENT]['database_servers']['master'],
-        port=SERVERDEFS[ENVIRONMENT]['database_servers']['port']
-    )
-    cursor = mariadb_connection.cursor()
+    delete_databases([site_sid])
 
-    # Drop database
-    try:
-        cursor.execute("DROP DATABASE IF EXISTS `{0}`;".format(site_sid))
-    except mariadb.Error as error:
-        log.error('Drop Database | %s | %s', site_sid, error)
 
-    # Drop user
-    try:
-        cursor.execute("DROP USER '{0}'@'{1}';".format(
-            site_sid,
-            SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern']))
-    except mariadb.Error as error:
-        log.error('Drop User | %s | %s', site_sid, error)
+def api_session():
+    """
+    Get the pooled, keep-alive session used for calls to the Atlas API.
+
+    The session is built once per process. It authenticates as the service account, keeps up to
+    API_POOL_MAXSIZE connections open per host, and retries idempotent requests with backoff.
+
+    :return: requests.Session
+    """
+    pid = os.getpid()
+    if _API_SESSION['pid'] != pid:
+        with _API_SESSION_LOCK:
+            if _API_SESSION['pid'] != pid:
+                session = requests.Session()
+                session.auth = (SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD)
+                session.verify = SSL_VERIFICATION
+                # Return the last response instead of raising once retries are exhausted, so
+                # callers keep seeing the Eve error payload.
+                retries = Retry(total=API_RETRIES,
+                                backoff_factor=API_RETRY_BACKOFF_FACTOR,
+                                status_forcelist=API_RETRY_STATUS_CODES,
+                                raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=API_POOL_CONNECTIONS,
+                                      pool_maxsize=API_POOL_MAXSIZE,
+                                      max_retries=retries)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                log.debug('Utilities | API session | New session | PID - %s', pid)
+                _API_SESSION['session'] = session
+                _API_SESSION['pid'] = pid
+    return _API_SESSION['session']
+
+
+def api_request(method, url, timeout=API_TIMEOUT, **kwargs):
+    """
+    Make a request to the Atlas API over the pooled session.
+
+    :param method: HTTP method
+    :param url: Full URL to request
+    :param timeout: Seconds to wait, either a float or a (connect, read) tuple
+    :param kwargs: Passed through to requests
+    :return: requests.Response
+    """
+    return api_session().request(method, url, timeout=timeout, **kwargs)
+
 
-    mariadb_connection.commit()
-    mariadb_connection.close()
-    log.info('Delete Database | %s | Success', site_sid)
+def api_session_stats():
+    """
+    Report how the pooled session has used its connections in this process.
+
+    :return: dict of 'opened' connections, 'requests' made, and 'reused' connections
+    """
+    stats = {'opened': 0, 'requests': 0, 'reused': 0}
+    if _API_SESSION['pid'] != os.getpid():
+        return stats
+    # The same adapter is mounted for both schemes.
+    for adapter in set(_API_SESSION['session'].adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['opened'] += pool.num_connections
+            stats['requests'] += pool.num_requests
+    stats['reused'] = stats['requests'] - stats['opened']
+    return stats
 
 
 def post_eve(resource, payload):
@@ -216,8 +513,7 @@ def post_eve(resource, payload):
     url = "{0}/{1}".format(API_URLS[ENVIRONMENT], resource)
     headers = {"content-type": "application/json"}
 
-    r = requests.post(url, auth=(SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD),
-                      headers=headers, verify=SSL_VERIFICATION, data=json.dumps(payload))
+    r = api_request('POST', url, headers=headers, data=json.dumps(payload))
 
     try:
         r.raise_for_status()
@@ -229,131 +525,300 @@ def post_eve(resource, payload):
     return r.json()
 
 
-def get_eve(resource, query=None):
+def _get_eve_page(url):
     """
-    Make calls to the Atlas API. This handles situations where there are many pages of results.
+    Get a single page of results from the Atlas API.
 
-    :param resource:
-    :param query: argument string
+    :param url: Full URL for the page
     :return: json result of request.
     """
-    url = API_URLS[ENVIRONMENT] + '/' + resource
+    log.debug('Utilities | Get Eve | Page url - %s', url)
+    r = api_request('GET', url)
+    r.raise_for_status()
+    return r.json()
+
+
+def projection_query(projection):
+    """
+    Build an Eve `projection` argument so that the API only returns the fields we need.
+
+    Eve always adds `_id`, `_etag`, `_created`, and `_updated` to the result.
+
+    :param projection: list of field names to include, or a dict in Eve projection format
+    :return: argument string
+    """
+    if not isinstance(projection, dict):
+        projection = dict((field, 1) for field in projection)
+    return 'projection={0}'.format(json.dumps(projection, separators=(',', ':')))
+
+
+def iter_eve(resource, query=None, page_size=PAGINATION_DEFAULT,
+             concurrency=API_PAGE_CONCURRENCY, projection=None):
+    """
+    Iterate over every item that matches a query, fetching pages in parallel.
+
+    The first page tells us how many pages there are. After that we keep at most `concurrency`
+    pages in flight and yield items in page order, so memory is bounded by
+    (concurrency + 1) * page_size items no matter how large the collection is.
+
+    :param resource: A resource as defined in data_structure.py
+    :param query: argument string
+    :param page_size: Items per page, up to PAGINATION_LIMIT
+    :param concurrency: Number of pages to request at once
+    :param projection: Only return these fields, see `projection_query`
+    :return: generator of item dicts
+    """
+    url = '{0}/{1}?'.format(API_URLS[ENVIRONMENT], resource)
     if query:
-        url = url + '?' + query
-        query_url = url
-        inital_url = url + '&max_results=1'
-    else:
-        inital_url = url + '?max_results=1'
-        query_url = None
-    log.debug('utilities | Get Eve | url - %s', url)
+        url += query + '&'
+    if projection:
+        url += projection_query(projection) + '&'
+    # Use a stable order, otherwise items can move between pages that are fetched in parallel.
+    if 'sort=' not in url:
+        url += 'sort=[("_id",1)]&'
+    page_url = url + 'max_results={0}&page={{0}}'.format(page_size)
 
     try:
-        # Get json output
-        r_inital = requests.get(
-            url,
-            auth=(SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD),
-            verify=SSL_VERIFICATION).json()
+        first_page = _get_eve_page(page_url.format(1))
     except Exception as error:
         log.error('GET to Atlas | URL - %s | Error - %s', url, error)
+        raise
+    num_pages = int(ceil(first_page['_meta']['total'] / float(page_size)))
+    log.debug('Utilities | Iter Eve | Resource - %s | Total - %s | Pages - %s',
+              resource, first_page['_meta']['total'], num_pages)
 
-    total_items = r_inital['_meta']['total']
-    json_result = None
+    if num_pages <= 1:
+        for item in first_page['_items']:
+            yield item
+        return
 
-    if total_items > PAGINATION_DEFAULT:
-        # Return the ceiling of x as a float, the smallest integer value greater than or equal to x.
-        num_pages = int(ceil(total_items/PAGINATION_DEFAULT))
-        # Range - Generate numbers from the first number up to, but not including the second.
-        for page in range(1, num_pages + 1):
-            if query_url:
-                page_url = query_url + '&page={0}&max_results={1}'.format(page, PAGINATION_DEFAULT)
-            else:
-                page_url = url + '?page={0}&max_results={1}'.format(page, PAGINATION_DEFAULT)
-            r_page = requests.get(
-                page_url,
-                auth=(SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD),
-                verify=SSL_VERIFICATION).json()
-            log.debug('utilities | Get eve | page request - %s', r_page)
-            # Merge lists
-            if json_result:
-                log.debug('Backup data | Original data - %s', json_result)
-                log.debug('Backup data | New data - %s', r_page)
-                json_result = json_result + r_page
-                log.debug('Backup data | Final data - %s', json_result)
-            else:
-                json_result = r_page
-    else:
-        if query_url:
-            total_url = query_url + '&max_results={0}'.format(total_items)
-        else:
-            total_url = url + '?max_results={0}'.format(total_items)
-        json_result = requests.get(total_url, auth=(
-            SERVICE_ACCOUNT_USERNAME,  SERVICE_ACCOUNT_PASSWORD), verify=SSL_VERIFICATION).json()
+    pool = ThreadPool(min(concurrency, num_pages - 1))
+    try:
+        pages = iter(range(2, num_pages + 1))
+        pending = deque(pool.apply_async(_get_eve_page, (page_url.format(page),))
+                        for page in islice(pages, concurrency))
+        for item in first_page['_items']:
+            yield item
+        while pending:
+            result = pending.popleft().get()
+            # Keep the window full before handing items back to the caller.
+            next_page = next(pages, None)
+            if next_page:
+                pending.append(pool.apply_async(_get_eve_page, (page_url.format(next_page),)))
+            for item in result['_items']:
+                yield item
+    finally:
+        pool.terminate()
+
+
+def get_eve(resource, query=None, projection=None):
+    """
+    Make calls to the Atlas API. This handles situations where there are many pages of results.
 
-    return json_result
+    Loads every matching item into memory, use `iter_eve` to stream large collections.
+
+    :param resource:
+    :param query: argument string
+    :param projection: Only return these fields, see `projection_query`
+    :return: json result of request.
+    """
+    items = list(iter_eve(resource, query, projection=projection))
+    return {'_items': items, '_meta': {'total': len(items)}}
 
 
-def get_single_eve(resource, id, version=None, env=ENVIRONMENT):
+def get_single_eve(resource, id, version=None, env=ENVIRONMENT, projection=None, cache=True):
     """
     Make calls to the Atlas API.
 
+    Items from API_CACHE_RESOURCES are kept in a process local LRU cache. A cached item is returned
+    without a request for API_CACHE_TTL seconds. After that we revalidate it with `If-None-Match`,
+    and Eve answers with a 304 instead of the full document if it has not changed. Specific
+    versions never change, so they are not revalidated.
+
     :param resource:
     :param id: _id string
+    :param projection: Only return these fields, see `projection_query`
+    :param cache: Set to False to skip the cache and always get a fresh item
     :return: dict of items that match the query string.
     """
+    url = "{0}/{1}/{2}".format(API_URLS[env], resource, id)
+    arguments = []
     if version:
-        url = "{0}/{1}/{2}?version={3}".format(API_URLS[env], resource, id, version)
-    else:
-        url = "{0}/{1}/{2}".format(API_URLS[env], resource, id)
+        arguments.append('version={0}'.format(version))
+    if projection:
+        arguments.append(projection_query(projection))
+    if arguments:
+        url = url + '?' + '&'.join(arguments)
     log.debug('utilities | Get Eve Single | url - %s', url)
 
-    r = requests.get(url, auth=(SERVICE_ACCOUNT_USERNAME,
-                                SERVICE_ACCOUNT_PASSWORD), verify=SSL_VERIFICATION)
+    if not cache or resource not in API_CACHE_RESOURCES:
+        return api_request('GET', url).json()
+
+    key = (env, resource, str(id), version, url)
+    with _API_CACHE_LOCK:
+        cached = _API_CACHE.get(key)
+        if cached:
+            # Mark as most recently used.
+            _API_CACHE[key] = _API_CACHE.pop(key)
+    headers = {}
+    if cached:
+        validated, record = cached
+        if version or time.time() - validated < API_CACHE_TTL:
+            log.debug('utilities | Get Eve Single | Cache hit | url - %s', url)
+            return deepcopy(record)
+        headers['If-None-Match'] = record['_etag']
+
+    r = api_request('GET', url, headers=headers)
+    if r.status_code == 304:
+        log.debug('utilities | Get Eve Single | Not modified | url - %s', url)
+    elif r.ok:
+        record = r.json()
+    else:
+        # Don't cache errors, and drop anything we had for this item.
+        with _API_CACHE_LOCK:
+            _API_CACHE.pop(key, None)
+        return r.json()
+
+    with _API_CACHE_LOCK:
+        _API_CACHE[key] = (time.time(), record)
+        while len(_API_CACHE) > API_CACHE_SIZE:
+            _API_CACHE.popitem(last=False)
+    return deepcopy(record)
 
-    return r.json()
 
-def patch_eve(resource, id, request_payload, env=ENVIRONMENT):
+def invalidate_single_eve(resource, id):
+    """
+    Remove every cached copy of an item, used after we change or delete it.
+
+    :param resource:
+    :param id: _id string
+    """
+    with _API_CACHE_LOCK:
+        for key in [key for key in _API_CACHE if key[1] == resource and key[2] == str(id)]:
+            del _API_CACHE[key]
+
+
+def write_eve(method, resource, id, etag=None, data=None, env=ENVIRONMENT):
+    """
+    Make a conditional write to an item in the Atlas API.
+
+    Pass the `_etag` from a record you already hold to save a request. If we don't have one, or
+    the item changed since we read it (412 Precondition Failed), we get the current `_etag` and try
+    again, up to API_PRECONDITION_RETRIES times.
+
+    :param method: 'PATCH', 'PUT', or 'DELETE'
+    :param resource:
+    :param id:
+    :param etag: `_etag` of the record the caller holds
+    :param data: Request body
+    :return: requests.Response
+    """
+    url = "{0}/{1}/{2}".format(API_URLS[env], resource, id)
+    for attempt in range(API_PRECONDITION_RETRIES + 1):
+        if not etag:
+            etag = get_single_eve(resource, id, env=env, cache=False)['_etag']
+        headers = {'Content-Type': 'application/json', 'If-Match': etag}
+        r = api_request(method, url, headers=headers, data=data)
+        if r.status_code != 412:
+            break
+        log.info('%s to Atlas | URL - %s | Etag out of date | Attempt - %s', method, url, attempt)
+        etag = None
+    invalidate_single_eve(resource, id)
+    return r
+
+
+def patch_eve(resource, id, request_payload, env=ENVIRONMENT, etag=None):
     """
     Patch items in the Atlas API.
 
     :param resource:
     :param id:
     :param request_payload:
+    :param etag: `_etag` of the record if the caller has it, see `write_eve`
     :return:
     """
-    url = "{0}/{1}/{2}".format(API_URLS[env], resource, id)
-    get_etag = get_single_eve(resource, id, env=env)
-    headers = {'Content-Type': 'application/json', 'If-Match': get_etag['_etag']}
-
     try:
-        r = requests.patch(url, headers=headers, data=json.dumps(request_payload), auth=(
-            SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD), verify=SSL_VERIFICATION)
-        log.info('PATCH to Atlas | URL - %s | Response - %s', url, r.text)
+        r = write_eve('PATCH', resource, id, etag=etag, data=json.dumps(request_payload), env=env)
+        log.info('PATCH to Atlas | URL - %s | Response - %s', r.url, r.text)
     except Exception as error:
-        log.error('PATCH to Atlas | URL - %s | Error - %s', url, error)
+        log.error('PATCH to Atlas | Resource - %s | ID - %s | Error - %s', resource, id, error)
+        raise
 
     return r.json()
 
 
-def delete_eve(resource, id):
+def delete_eve(resource, id, etag=None):
     """
-    Patch items in the Atlas API.
+    Delete items in the Atlas API.
 
     :param resource:
     :param id:
+    :param etag: `_etag` of the record if the caller has it, see `write_eve`
     :return:
     """
-    url = "{0}/{1}/{2}".format(API_URLS[ENVIRONMENT], resource, id)
-    get_etag = get_single_eve(resource, id)
-    headers = {'Content-Type': 'application/json', 'If-Match': get_etag['_etag']}
     try:
-        r = requests.delete(url, headers=headers, auth=(
-            SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD), verify=SSL_VERIFICATION)
+        r = write_eve('DELETE', resource, id, etag=etag)
     except Exception as error:
-        log.error('DELETE to Atlas | URL - %s | Error - %s', url, error)
+        log.error('DELETE to Atlas | Resource - %s | ID - %s | Error - %s', resource, id, error)
+        raise
 
     return r.status_code
 
 
+def bulk_eve(method, resource, items, batch_size=BULK_BATCH_SIZE):
+    """
+    Send many writes to the Atlas bulk endpoint, `batch_size` items per request.
+
+    :param method: 'PATCH' or 'DELETE'
+    :param resource:
+    :param items: list of dicts with '_id', '_etag', and for PATCH 'updates'
+    :param batch_size: Items per request
+    :return: list of per item results, each with '_id', '_status', and '_etag' or '_error'
+    """
+    url = "{0}/bulk/{1}".format(API_URLS[ENVIRONMENT], resource)
+    headers = {'Content-Type': 'application/json'}
+    results = []
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        r = api_request(method, url, headers=headers, data=json.dumps(batch))
+        for item in batch:
+            invalidate_single_eve(resource, item['_id'])
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError:
+            log.error('Bulk %s to Atlas | URL - %s | Error - %s', method, url, r.text)
+            raise
+        results.extend(r.json()['_items'])
+    failed = [result for result in results if result['_status'] != 'OK']
+    log.info('Bulk %s to Atlas | URL - %s | Items - %s | Failed - %s',
+             method, url, len(results), len(failed))
+    if failed:
+        log.error('Bulk %s to Atlas | URL - %s | Failed items - %s', method, url, failed)
+    return results
+
+
+def bulk_patch_eve(resource, items, batch_size=BULK_BATCH_SIZE):
+    """
+    Patch many items in the Atlas API with one request per batch.
+
+    :param resource:
+    :param items: list of {'_id': ..., '_etag': ..., 'updates': {...}}
+    :return: list of per item results
+    """
+    return bulk_eve('PATCH', resource, items, batch_size)
+
+
+def bulk_delete_eve(resource, items, batch_size=BULK_BATCH_SIZE):
+    """
+    Delete many items in the Atlas API with one request per batch.
+
+    :param resource:
+    :param items: list of {'_id': ..., '_etag': ...}
+    :return: list of per item results
+    """
+    return bulk_eve('DELETE', resource, items, batch_size)
+
+
 def get_current_code(name, code_type):
     """
     Get the current code item for a given name and type.
@@ -364,7 +829,7 @@ def get_current_code(name, code_type):
     """
     query = 'where={{"meta.name":"{0}","meta.code_type":"{1}","meta.is_current":true}}'.format(
         name, code_type)
-    current_code = get_eve('code', query)
+    current_code = get_eve('code', query, projection=['_id'])
     if current_code['_meta']['total'] != 0:
         return current_code['_items'][0]['_id']
     else:
@@ -407,15 +872,20 @@ def ignore_code_file(file_to_check):
     Returns:
         bool -- TRUE if file should be ignored
     """
-    # Join all regex expressions into a single expression with the pipe seperator.
-    # We use '?:' since we don't care which expression matches.
-    regex = '(?:%s)' % '|'.join(INSTANCE_CODE_IGNORE_REGEX)
-    log.debug('Utilities | Ignore code file | regex - %s', regex)
-    # Multiline modifier: ^ and $ to match the begin/end of each line (not only begin/end of string)
-    search = re.search(regex, file_to_check, re.MULTILINE)
-    if not search:
-        log.debug('Utilities | Ignore code file | File - %s | result - %s', file_to_check, search)
-    return bool(search)
+    return bool(CODE_IGNORE_MATCHER.search(file_to_check))
+
+
+def filter_code_files(names):
+    """Remove the files that match one of the INSTANCE_CODE_IGNORE_REGEX regexes
+
+    Arguments:
+        names {list} -- filenames to check, usually a directory listing
+
+    Returns:
+        list -- filenames that should be linked, in the same order
+    """
+    search = CODE_IGNORE_MATCHER.search
+    return [name for name in names if not search(name)]
 
 
 def get_code(name, code_type=''):
@@ -575,49 +1045,52 @@ def create_saml_database():
     """
     log.info('Create SAML Database')
     # Start connection
-    mariadb_connection = mariadb.connect(
-        user=DATABASE_USER,
-        password=DATABASE_PASSWORD,
-        host=SERVERDEFS[ENVIRONMENT]['database_servers']['master'],
-        port=SERVERDEFS[ENVIRONMENT]['database_servers']['port']
-    )
-
+    mariadb_connection = database_connection()
     cursor = mariadb_connection.cursor()
-
-    # Create database
-    try:
-        cursor.execute("CREATE DATABASE `saml`;")
-    except mariadb.Error as error:
-        log.error('Create Database | saml | %s', error)
-        raise
-
-    instance_database_password = SAML_AUTH
-    # Add user
     try:
-        if ENVIRONMENT != 'local':
-            cursor.execute("CREATE USER 'saml'@'{0}' IDENTIFIED BY '{1}';".format(
-                SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern'],
-                instance_database_password))
-        else:
-            cursor.execute("CREATE USER 'saml'@'localhost' IDENTIFIED BY '{0}';".format(
-                instance_database_password))
-    except mariadb.Error as error:
-        log.error('Create User | saml | %s', error)
-        raise
+        # Create database
+        try:
+            database_execute(cursor, 'create_database', "CREATE DATABASE `saml`;")
+        except mariadb.Error as error:
+            log.error('Create Database | saml | %s', error)
+            raise
 
-    # Grant privileges
-    try:
-        if ENVIRONMENT != 'local':
-            cursor.execute("GRANT ALL PRIVILEGES ON saml.* TO 'saml'@'{0}';".format(
-                SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern']))
-        else:
-            cursor.execute("GRANT ALL PRIVILEGES ON saml.* TO 'saml'@'localhost';")
-    except mariadb.Error as error:
-        log.error('Grant Privileges | saml | %s', error)
-        raise
+        instance_database_password = SAML_AUTH
+        # Add user
+        try:
+            if ENVIRONMENT != 'local':
+                database_execute(
+                    cursor, 'create_user',
+                    "CREATE USER 'saml'@'{0}' IDENTIFIED BY '{1}';".format(
+                        SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern'],
+                        instance_database_password))
+            else:
+                database_execute(
+                    cursor, 'create_user',
+                    "CREATE USER 'saml'@'localhost' IDENTIFIED BY '{0}';".format(
+                        instance_database_password))
+        except mariadb.Error as error:
+            log.error('Create User | saml | %s', error)
+            raise
+
+        # Grant privileges
+        try:
+            if ENVIRONMENT != 'local':
+                database_execute(
+                    cursor, 'grant',
+                    "GRANT ALL PRIVILEGES ON saml.* TO 'saml'@'{0}';".format(
+                        SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern']))
+            else:
+                database_execute(cursor, 'grant',
+                                 "GRANT ALL PRIVILEGES ON saml.* TO 'saml'@'localhost';")
+        except mariadb.Error as error:
+            log.error('Grant Privileges | saml | %s', error)
+            raise
 
-    mariadb_connection.commit()
-    mariadb_connection.close()
+        mariadb_connection.commit()
+    finally:
+        cursor.close()
+        mariadb_connection.close()
 
     log.info('Create Database | saml | Success')
 
@@ -630,32 +1103,31 @@ def delete_saml_database():
     """
     log.info('Delete Database | saml')
     # Start connection
-    mariadb_connection = mariadb.connect(
-        user=DATABASE_USER,
-        password=DATABASE_PASSWORD,
-        host=SERVERDEFS[ENVIRONMENT]['database_servers']['master'],
-        port=SERVERDEFS[ENVIRONMENT]['database_servers']['port']
-    )
+    mariadb_connection = database_connection()
     cursor = mariadb_connection.cursor()
-
-    # Drop database
-    try:
-        cursor.execute("DROP DATABASE IF EXISTS `saml`;")
-    except mariadb.Error as error:
-        log.error('Drop Database | saml | %s', error)
-
-    # Drop user
     try:
-        if ENVIRONMENT != 'local':
-            cursor.execute("DROP USER 'saml'@'{0}';".format(
-                SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern']))
-        else:
-            cursor.execute("DROP USER 'saml'@'localhost';")
-    except mariadb.Error as error:
-        log.error('Drop User | saml | %s', error)
+        # Drop database
+        try:
+            database_execute(cursor, 'drop_database', "DROP DATABASE IF EXISTS `saml`;")
+        except mariadb.Error as error:
+            log.error('Drop Database | saml | %s', error)
 
-    mariadb_connection.commit()
-    mariadb_connection.close()
+        # Drop user
+        try:
+            if ENVIRONMENT != 'local':
+                database_execute(
+                    cursor, 'drop_user',
+                    "DROP USER 'saml'@'{0}';".format(
+                        SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern']))
+            else:
+                database_execute(cursor, 'drop_user', "DROP USER 'saml'@'localhost';")
+        except mariadb.Error as error:
+            log.error('Drop User | saml | %s', error)
+
+        mariadb_connection.commit()
+    finally:
+        cursor.close()
+        mariadb_connection.close()
     log.info('Delete Database | saml | Success')
 
 
@@ -663,19 +1135,88 @@ def relative_symlink(source, destination):
     os.symlink(os.path.relpath(source, os.path.dirname(destination)), destination)
 
 
+def rsync_host(cmd, host):
+    """Run an rsync command for a single host
+
+    Arguments:
+        cmd {string} -- rsync command, run with `--stats` so we can read the bytes sent
+        host {string} -- host the command syncs to
+
+    Returns:
+        dict -- 'host', 'returncode', 'bytes' sent, 'duration' in seconds, and 'output' on failure
+    """
+    log.debug('Utilities | Sync | Command - %s | Host - %s', cmd, host)
+    result = {'host': host, 'returncode': 0, 'bytes': 0, 'duration': 0.0}
+    start_time = time.time()
+    try:
+        output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        result['returncode'] = e.returncode
+        result['output'] = e.output
+        log.error('Utilities | Sync | Failed | Return code - %s | StdErr - %s | Host - %s',
+                  e.returncode, e.output, host)
+    except OSError as e:
+        # rsync could not be started at all.
+        result['returncode'] = -1
+        result['output'] = str(e)
+        log.error('Utilities | Sync | Failed | Error - %s | Host - %s', e, host)
+    else:
+        bytes_sent = RSYNC_BYTES_SENT.search(output)
+        if bytes_sent:
+            result['bytes'] = int(bytes_sent.group(1).replace(',', ''))
+        log.info('Utilities | Sync | Success | Host - %s', host)
+    result['duration'] = time.time() - start_time
+    return result
+
+
+def rsync_hosts(source, commands):
+    """Run rsync commands for many hosts in parallel, up to SYNC_MAX_WORKERS at a time
+
+    Arguments:
+        source {string|list} -- what is being synced, for the result and logs
+        commands {dict} -- rsync command keyed on host
+
+    Returns:
+        dict -- 'success' if every host synced, total 'duration', and the result for each host
+            keyed on host, see `rsync_host`
+    """
+    start_time = time.time()
+    results = []
+    if commands:
+        pool = ThreadPool(min(SYNC_MAX_WORKERS, len(commands)))
+        try:
+            results = pool.map(lambda host: rsync_host(commands[host], host), commands.keys())
+        finally:
+            pool.close()
+            pool.join()
+    sync_result = {
+        'source': source,
+        'success': all(result['returncode'] == 0 for result in results),
+        'duration': time.time() - start_time,
+        'hosts': dict((result['host'], result) for result in results),
+    }
+    log.info('Utilities | Sync | Source - %s | Success - %s | Duration - %.2fs | Bytes - %s',
+             source, sync_result['success'], sync_result['duration'],
+             sum(result['bytes'] for result in results))
+    return sync_result
+
+
 def sync(source, hosts, target, exclude=None):
     """Sync files, symlinks, and directories between servers
 
+    Hosts are synced in parallel, up to SYNC_MAX_WORKERS at a time.
+
     Arguments:
         source {string} -- source path
         hosts {list} -- list of hosts to sync to, will be deduped by function
         target {string} -- destination path
         exclude {string} -- directory to exclude from rsync
+
+    Returns:
+        dict -- see `rsync_hosts`
     """
 
     log.info('Utilities | Sync | Source - %s', source)
-    # Use `set` to dedupe the host list, and cast it back into a list
-    hosts = list(set(hosts))
     # Recreate readme
     filename = source + "/README.md"
     # Remove the existing file.
@@ -684,22 +1225,59 @@ def sync(source, hosts, target, exclude=None):
     f = open(filename, "w+")
     f.write("Directory is synced from Atlas. Any changes will be overwritten.")
     f.close()
+    # -a archive mode; equals -rlptgoD
+    # -z compress file data during the transfer
+    # --stats report the transfer, we read the bytes sent from it
+    # trailing slash on src copies the contents, not the parent dir itself.
+    # --delete delete extraneous files from dest dirs
+    commands = {}
+    # Keying on host dedupes the host list.
     for host in hosts:
-        # -a archive mode; equals -rlptgoD
-        # -z compress file data during the transfer
-        # trailing slash on src copies the contents, not the parent dir itself.
-        # --delete delete extraneous files from dest dirs
         if exclude:
-            cmd = 'rsync -aqz --exclude={0} {1}/ {2}:{3} --delete'.format(exclude, source, host, target)
-        else:
-            cmd = 'rsync -aqz {0}/ {1}:{2} --delete'.format(source, host, target)
-        log.debug('Utilities | Sync | Command - %s | Host - %s', cmd, host)
-        try:
-            output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            log.error('Utilities | Sync | Failed | Return code - %s | StdErr - %s | Host - %s', e.returncode, e.output, host)
+            commands[host] = 'rsync -az --stats --exclude={0} {1}/ {2}:{3} --delete'.format(
+                exclude, source, host, target)
         else:
-            log.info('Utilities | Sync | Success | Host - %s', host)
+            commands[host] = 'rsync -az --stats {0}/ {1}:{2} --delete'.format(source, host, target)
+    return rsync_hosts(source, commands)
+
+
+def sync_paths(paths, hosts, exclude=None):
+    """Sync many absolute paths to the same location on other servers with one rsync per host
+
+    Paths that no longer exist locally are removed from the hosts.
+
+    Arguments:
+        paths {list} -- absolute paths to sync, directories are synced with their contents
+        hosts {list} -- list of hosts to sync to, will be deduped by function
+        exclude {string} -- directory to exclude from rsync
+
+    Returns:
+        dict -- see `rsync_hosts`
+    """
+    log.info('Utilities | Sync paths | Count - %s', len(paths))
+    log.debug('Utilities | Sync paths | Paths - %s', paths)
+    # The paths go in a file, a command line with thousands of paths is too long to run.
+    # --files-from read the paths relative to the source, /, and keep the full path on the host
+    #   (implies -R). -r is not implied by -a with --files-from, so it is set explicitly.
+    # --from0 the paths are separated by null bytes.
+    # --delete-missing-args remove paths on the host that are missing locally, needs rsync 3.1.
+    files_from = tempfile.NamedTemporaryFile(prefix='atlas_sync_', suffix='.list', delete=False)
+    try:
+        with files_from:
+            files_from.write('\0'.join(path.lstrip('/') for path in paths))
+        options = '-azr --stats --delete --delete-missing-args --from0 --files-from={0}'.format(
+            files_from.name)
+        if CODE_STORE_ROOT:
+            # Keep code versions linked to the store on the hosts too, see `code_operations`.
+            options += ' -H'
+        if exclude:
+            options += ' --exclude={0}'.format(exclude)
+        commands = {}
+        for host in hosts:
+            commands[host] = 'rsync {0} / {1}:/'.format(options, host)
+        return rsync_hosts(paths, commands)
+    finally:
+        os.remove(files_from.name)
 
 
 def file_accessable_and_writable(file):
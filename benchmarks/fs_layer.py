@@ -0,0 +1,268 @@
+"""
+    benchmarks.fs_layer
+    ~~~~~~~~~~~~~~~~~~~
+    Time the filesystem and sync layer against a synthetic CODE_ROOT, INSTANCE_ROOT, and WEB_ROOT.
+
+    Everything lives in a temp directory. Config is loaded from the `.example` files with the
+    roots pointed into it, and code items are served from memory instead of the Atlas API. The
+    "webservers" are directories too: rsync runs through a stand-in remote shell that writes each
+    host into its own directory, so syncs use the real rsync protocol without ssh.
+
+    After provisioning, every instance is checked against its layout and the run fails if a fresh
+    instance shows any drift.
+
+    python benchmarks/fs_layer.py [--instances 100] [--packages 40] [--hosts 3] [--nfs]
+        [--json out.json]
+"""
+import argparse
+import grp
+import imp
+import json
+import os
+import pwd
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+ATLAS_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ATLAS_ROOT)
+
+# Remote shell for rsync. Called as `rsh HOST rsync --server ... DEST`, runs the server locally with
+# DEST moved under the directory for HOST.
+RSH_TEMPLATE = """#!{python}
+import os, sys
+host, command = sys.argv[1], sys.argv[2:]
+root = os.path.join({hosts_dir!r}, host)
+if not os.path.isdir(root):
+    os.makedirs(root)
+command[-1] = os.path.join(root, command[-1].lstrip('/'))
+os.execvp(command[0], command)
+"""
+
+
+def load_config(base, host_count, nfs=False):
+    """
+    Register `atlas.config_local` and `atlas.config_servers` built from the example files, with
+    every path inside `base`.
+    """
+    from cryptography.fernet import Fernet
+
+    config_local = imp.new_module('atlas.config_local')
+    execfile(os.path.join(ATLAS_ROOT, 'atlas/config_local.py.example'), config_local.__dict__)
+    config_local.CODE_ROOT = os.path.join(base, 'code')
+    config_local.WEB_ROOT = os.path.join(base, 'web')
+    config_local.INSTANCE_ROOT = os.path.join(base, 'instances')
+    config_local.SITE_DOWN_PATH = os.path.join(base, 'code/down')
+    config_local.STATIC_WEB_PATH = os.path.join(base, 'web/static')
+    config_local.BACKUP_PATH = os.path.join(base, 'backup')
+    config_local.LOG_LOCATION = os.path.join(base, 'atlas.log')
+    config_local.NFS_MOUNT_FILES_DIR = nfs
+    config_local.ENCRYPTION_KEY = Fernet.generate_key()
+    config_local.SSH_USER = pwd.getpwuid(os.getuid()).pw_name
+    config_local.WEBSERVER_USER = config_local.SSH_USER
+    config_local.WEBSERVER_USER_GROUP = grp.getgrgid(os.getgid()).gr_name
+    sys.modules['atlas.config_local'] = config_local
+
+    config_servers = imp.new_module('atlas.config_servers')
+    execfile(os.path.join(ATLAS_ROOT, 'atlas/config_servers.py.example'), config_servers.__dict__)
+    hosts = ['web{0}'.format(number) for number in range(1, host_count + 1)]
+    config_servers.SERVERDEFS['local']['webservers'] = hosts
+    config_servers.SERVERDEFS['local']['operations_server'] = hosts[:1]
+    config_servers.NFS_MOUNT_LOCATION['local'] = os.path.join(base, 'nfs')
+    sys.modules['atlas.config_servers'] = config_servers
+
+    for directory in [config_local.CODE_ROOT, config_local.WEB_ROOT, config_local.INSTANCE_ROOT,
+                      config_local.STATIC_WEB_PATH, config_servers.NFS_MOUNT_LOCATION['local']]:
+        os.makedirs(directory)
+
+    # Settings that are not read from config_local have to be changed before the modules that use
+    # them are imported.
+    from atlas import config
+    config.SYNC_SPOOL_DIR = os.path.join(base, 'sync_spool')
+    config.SYNC_DEBOUNCE = 0
+    return config
+
+
+def write_file(path, content='<?php\n'):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def build_code(utilities, package_count):
+    """
+    Create a core, a profile, and packages on disk.
+
+    :return: dict of code items keyed on id
+    """
+    items = {}
+
+    def add(code_id, name, version, code_type, files):
+        item = {'_id': code_id,
+                'meta': {'name': name, 'version': version, 'code_type': code_type,
+                         'is_current': True}}
+        path = utilities.code_path(item)
+        for filename in files:
+            write_file(os.path.join(path, filename))
+        items[code_id] = item
+
+    core_files = ['index.php', 'cron.php', 'update.php', 'install.php', 'authorize.php',
+                  'xmlrpc.php', 'robots.txt', 'web.config', 'README.txt', '.gitignore',
+                  'sites/default/default.settings.php', 'sites/all/README.txt',
+                  'profiles/standard/standard.info', 'profiles/minimal/minimal.info']
+    for directory in ['includes', 'misc', 'modules', 'scripts', 'themes']:
+        core_files.extend('{0}/file{1}.inc'.format(directory, number) for number in range(20))
+    add('core', 'drupal', '7.x', 'core', core_files)
+    add('profile', 'express', '2.x', 'profile',
+        ['express.info', 'express.profile'] +
+        ['modules/module{0}/module{0}.module'.format(number) for number in range(50)])
+    for number in range(package_count):
+        code_type = ['module', 'theme', 'library'][number % 3]
+        add('package{0}'.format(number), '{0}{1}'.format(code_type, number), '1.0', code_type,
+            ['{0}.info'.format(number), 'src/file.inc', 'README.md'])
+    return items
+
+
+def build_instances(utilities, count, packages):
+    instances = []
+    for number in range(count):
+        sid = 'p1{0:010x}'.format(number)
+        instances.append({
+            '_id': 'instance{0}'.format(number),
+            'sid': sid,
+            'path': sid,
+            'status': 'installed',
+            'type': 'express',
+            'statistics': 'statistics{0}'.format(number),
+            'db_key': utilities.encrypt_string('password'),
+            'settings': {'page_cache_maximum_age': 300},
+            'code': {'core': 'core', 'profile': 'profile',
+                     'package': packages[number % len(packages):][:5] if packages else []},
+        })
+    return instances
+
+
+def timed(results, name, operations, function):
+    start_time = time.time()
+    extra = function()
+    wall = time.time() - start_time
+    results[name] = {'operations': operations, 'wall': wall,
+                     'ops_per_sec': operations / wall if wall else None}
+    if extra:
+        results[name].update(extra)
+    print('{0:<24} {1:>8} ops {2:>9.2f}s {3:>10.1f} ops/sec'.format(
+        name, operations, wall, results[name]['ops_per_sec'] or 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the Atlas filesystem and sync layer.')
+    parser.add_argument('--instances', type=int, default=100)
+    parser.add_argument('--packages', type=int, default=40)
+    parser.add_argument('--hosts', type=int, default=3)
+    parser.add_argument('--changed', type=float, default=0.1,
+                        help='Fraction of instances to change before the incremental sync.')
+    parser.add_argument('--nfs', action='store_true',
+                        help='Link the files directory of each instance to the NFS mount.')
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('--keep', action='store_true', help='Keep the temp directory.')
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='atlas_fs_bench_')
+    hosts_dir = os.path.join(base, 'hosts')
+    rsh = os.path.join(base, 'rsh.py')
+    with open(rsh, 'w') as f:
+        f.write(RSH_TEMPLATE.format(python=sys.executable, hosts_dir=hosts_dir))
+    os.chmod(rsh, stat.S_IRWXU)
+    os.environ['RSYNC_RSH'] = rsh
+
+    try:
+        load_config(base, args.hosts, args.nfs)
+        from atlas import utilities, instance_operations, code_operations
+
+        code = build_code(utilities, args.packages)
+        utilities.get_single_eve = lambda resource, code_id, *a, **kw: code[code_id]
+        packages = sorted(code_id for code_id in code if code_id.startswith('package'))
+        instances = build_instances(utilities, args.instances, packages)
+        changed = instances[:max(1, int(len(instances) * args.changed))]
+        can_sync = find_executable('rsync') is not None
+        results = {}
+        print('Instances - {0} | Packages - {1} | Hosts - {2} | Root - {3}'.format(
+            args.instances, args.packages, args.hosts, base))
+
+        def provision():
+            for instance in instances:
+                instance_operations.instance_create(instance)
+
+        def drift():
+            # A freshly created instance has to match its layout exactly, or heal would change it.
+            drifted = {}
+            for instance in instances:
+                changes = instance_operations.apply_layout(instance, dry_run=True)
+                if changes:
+                    drifted[instance['sid']] = ['{0} {1}'.format(change['action'], change['path'])
+                                                for change in changes]
+            if drifted:
+                raise AssertionError('Fresh instances have drifted - {0}'.format(drifted))
+            return {'drifted': len(drifted)}
+
+        def permissions():
+            for instance in instances:
+                instance_operations.correct_fs_permissions(instance)
+
+        def sync_result(result):
+            return {'bytes': sum(host['bytes'] for host in result['hosts'].values()),
+                    'success': result['success']}
+
+        def sync_full():
+            return sync_result(instance_operations.sync_instances(full=True))
+
+        def sync_changed():
+            for instance in changed:
+                # Unchanged settings files are not rewritten, so change one.
+                instance['settings']['page_cache_maximum_age'] += 60
+                instance_operations.switch_settings_files(instance)
+            return sync_result(instance_operations.sync_instances())
+
+        def heal():
+            for instance in instances:
+                instance_operations.apply_layout(instance)
+                instance_operations.switch_settings_files(instance)
+                instance_operations.correct_fs_permissions(instance)
+            if can_sync:
+                return sync_result(instance_operations.sync_instances())
+
+        def sync_code():
+            results = code_operations.sync_code()
+            return {'success': all(result['success'] for result in results)}
+
+        def sync_code_item():
+            results = code_operations.sync_code([code['core']])
+            return {'success': all(result['success'] for result in results)}
+
+        timed(results, 'provision', len(instances), provision)
+        timed(results, 'drift', len(instances), drift)
+        timed(results, 'permissions', len(instances), permissions)
+        if can_sync:
+            timed(results, 'sync_full', 1, sync_full)
+            timed(results, 'sync_changed', len(changed), sync_changed)
+            timed(results, 'sync_code', 1, sync_code)
+            timed(results, 'sync_code_item', 1, sync_code_item)
+        else:
+            print('rsync is not installed, skipping sync workloads')
+        timed(results, 'heal', len(instances), heal)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    finally:
+        if not args.keep:
+            shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""
+    benchmarks.query_indexes
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+    Seed a scratch MongoDB database with realistic volumes and explain the queries Atlas runs.
+
+    Every query should report an IXSCAN with docs examined close to docs returned. Queries are
+    sorted on `_id` unless they have their own sort, like `utilities.iter_eve` does. Run with
+    `--no-indexes` to see the same queries without the `mongo_indexes` from `data_structure.py`.
+
+    python benchmarks/query_indexes.py [--sites 10000] [--backups 100000] [--no-indexes]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from atlas.data_structure import DOMAIN, MONGO_HOST, MONGO_PORT
+
+STATUSES = ['pending', 'available', 'installing', 'installed', 'launching', 'launched',
+            'locked', 'take_down', 'down', 'restore']
+BACKUP_STATES = ['pending', 'complete']
+BACKUP_TYPES = ['routine', 'update', 'on_demand']
+# Most documents a query may examine for each one it returns.
+EXAMINED_RATIO = 2
+
+
+def seed(db, sites_count, backups_count):
+    """
+    Replace the benchmark collections with generated documents.
+    """
+    now = datetime.utcnow()
+    code = []
+    for code_type in ['core', 'profile', 'module', 'theme', 'library', 'static']:
+        for name in range(20):
+            for version in range(5):
+                code.append({
+                    '_id': ObjectId(),
+                    'meta': {'name': '{0}_{1}'.format(code_type, name),
+                             'version': '7.x-{0}'.format(version),
+                             'code_type': code_type,
+                             'is_current': version == 4},
+                    '_created': now - timedelta(days=random.randint(0, 400)),
+                    '_deleted': False,
+                })
+    cores = [item['_id'] for item in code if item['meta']['code_type'] == 'core']
+    profiles = [item['_id'] for item in code if item['meta']['code_type'] == 'profile']
+    packages = [item['_id'] for item in code
+                if item['meta']['code_type'] in ['module', 'theme', 'library']]
+
+    sites = []
+    statistics = []
+    for count in range(sites_count):
+        site_id = ObjectId()
+        statistic_id = ObjectId()
+        sites.append({
+            '_id': site_id,
+            'sid': 'p1{0:010x}'.format(count),
+            'path': 'site{0}'.format(count),
+            'status': random.choice(STATUSES),
+            'update_group': random.randint(0, 5),
+            'statistics': statistic_id,
+            'code': {'core': random.choice(cores),
+                     'profile': random.choice(profiles),
+                     'package': random.sample(packages, random.randint(0, 5))},
+            '_created': now - timedelta(days=random.randint(0, 700)),
+            '_deleted': False,
+        })
+        statistics.append({
+            '_id': statistic_id,
+            'site': site_id,
+            'status': random.choice(STATUSES),
+            'days_since_last_edit': random.randint(0, 400),
+            '_updated': now - timedelta(hours=random.randint(0, 72)),
+            '_deleted': False,
+        })
+
+    for name, documents in [('code', code), ('sites', sites), ('statistics', statistics)]:
+        db[name].drop()
+        db[name].insert_many(documents)
+
+    db['backup'].drop()
+    batch = []
+    for count in range(backups_count):
+        batch.append({
+            'site': random.choice(sites)['_id'],
+            'state': random.choice(BACKUP_STATES),
+            'backup_type': random.choice(BACKUP_TYPES),
+            '_created': now - timedelta(days=random.randint(0, 120)),
+        })
+        if len(batch) == 10000:
+            db['backup'].insert_many(batch)
+            batch = []
+    if batch:
+        db['backup'].insert_many(batch)
+    return sites, code
+
+
+def create_indexes(db):
+    """
+    Create the indexes declared in `data_structure.py`, the same way Eve does on startup.
+    """
+    for resource, definition in DOMAIN.items():
+        for name, keys in definition.get('mongo_indexes', {}).items():
+            db[resource].create_index(keys, name=name, background=True)
+
+
+def queries(sites, code):
+    """
+    The query shapes that the API, tasks, and callbacks send to Eve, with the filters Eve adds.
+    """
+    now = datetime.utcnow()
+    site = random.choice(sites)
+    core = random.choice([item for item in code if item['meta']['code_type'] == 'core'])
+    package = random.choice([item for item in code if item['meta']['code_type'] == 'module'])
+    live = {'_deleted': {'$ne': True}}
+
+    def not_deleted(query):
+        query = dict(query)
+        query.update(live)
+        return query
+
+    return [
+        ('sites by status', 'sites', not_deleted({'status': 'installed'}), None),
+        ('sites by status $in', 'sites',
+         not_deleted({'status': {'$in': ['pending', 'available']}}), None),
+        ('sites by path', 'sites', not_deleted({'path': site['path']}), None),
+        ('sites by path $in', 'sites',
+         not_deleted({'path': {'$in': [item['path'] for item in sites[:20]]}}), None),
+        ('sites by sid', 'sites', not_deleted({'sid': site['sid']}), None),
+        ('sites by statistics $in', 'sites',
+         not_deleted({'statistics': {'$in': [item['statistics'] for item in sites[:50]]}}), None),
+        ('sites by code.core', 'sites', not_deleted({'code.core': core['_id']}), None),
+        ('sites by code.profile', 'sites',
+         not_deleted({'code.profile': site['code']['profile']}), None),
+        ('sites by code.package', 'sites', not_deleted({'code.package': package['_id']}), None),
+        ('statistics by site', 'statistics', not_deleted({'site': site['_id']}), None),
+        ('statistics by _updated', 'statistics',
+         not_deleted({'_updated': {'$lte': now - timedelta(hours=36)}}), None),
+        ('statistics by status and days_since_last_edit', 'statistics',
+         not_deleted({'status': {'$in': ['installed', 'launched']}, 'days_since_last_edit': 0,
+                      'site': {'$nin': [item['_id'] for item in sites[:20]]}}), None),
+        ('backup by site sorted by _created', 'backup', {'site': site['_id']},
+         [('_created', 1)]),
+        ('backup pending older than 90 minutes', 'backup',
+         {'state': 'pending', '_created': {'$lte': now - timedelta(minutes=90)}}, None),
+        ('backup complete routine in last day', 'backup',
+         {'state': 'complete', 'backup_type': 'routine',
+          '_created': {'$gte': now - timedelta(hours=24)}}, None),
+        ('backup older than 90 days', 'backup',
+         {'_created': {'$lte': now - timedelta(days=90)}}, None),
+        ('code current by name and type', 'code',
+         not_deleted({'meta.name': core['meta']['name'], 'meta.code_type': 'core',
+                      'meta.is_current': True}), None),
+        ('code by name', 'code', not_deleted({'meta.name': core['meta']['name']}), None),
+        ('code old and not current', 'code',
+         not_deleted({'meta.is_current': False, '_created': {'$lte': now - timedelta(days=90)}}),
+         None),
+    ]
+
+
+def winning_stages(plan):
+    """
+    Flatten the stages of a winning plan, outermost first.
+    """
+    stages = [plan['stage']]
+    for key in ['inputStage', 'inputStages']:
+        children = plan.get(key)
+        if isinstance(children, dict):
+            children = [children]
+        for child in children or []:
+            stages.extend(winning_stages(child))
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', default='atlas_benchmark')
+    parser.add_argument('--sites', type=int, default=10000)
+    parser.add_argument('--backups', type=int, default=100000)
+    parser.add_argument('--no-indexes', action='store_true')
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_HOST, int(MONGO_PORT))[args.db]
+    start = time.time()
+    sites, code = seed(db, args.sites, args.backups)
+    print('Seeded {0} sites and {1} backups in {2:.1f}s'.format(
+        args.sites, args.backups, time.time() - start))
+    if not args.no_indexes:
+        create_indexes(db)
+
+    print('{0:<48} {1:<28} {2:>9} {3:>9} {4:>7}'.format(
+        'Query', 'Plan', 'Examined', 'Returned', 'ms'))
+    collection_scans = 0
+    over_examined = 0
+    for label, resource, query, sort in queries(sites, code):
+        # The API sorts every query on _id unless it has a sort, see `utilities.iter_eve`.
+        cursor = db[resource].find(query).sort(sort or [('_id', 1)])
+        explain = cursor.explain()
+        stats = explain['executionStats']
+        stages = winning_stages(explain['queryPlanner']['winningPlan'])
+        if 'COLLSCAN' in stages:
+            collection_scans += 1
+        # An IXSCAN on _id for the sort still examines every document.
+        flag = ''
+        if stats['totalDocsExamined'] > EXAMINED_RATIO * max(stats['nReturned'], 1):
+            over_examined += 1
+            flag = ' *'
+        print('{0:<48} {1:<28} {2:>9} {3:>9} {4:>7}{5}'.format(
+            label, '>'.join(stages), stats['totalDocsExamined'], stats['nReturned'],
+            stats['executionTimeMillis'], flag))
+
+    db.client.drop_database(args.db)
+    print('Collection scans - {0} | Examined more than {1}x returned (*) - {2}'.format(
+        collection_scans, EXAMINED_RATIO, over_examined))
+    return 1 if (collection_scans or over_examined) and not args.no_indexes else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
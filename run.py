@@ -9,19 +9,30 @@ import json
 import logging
 from logging.handlers import WatchedFileHandler
 import ssl
+import time
 
 from collections import Counter
+from copy import deepcopy
 from datetime import datetime
+from bson import ObjectId
+from bson.errors import InvalidId
 from eve import Eve
 from eve.auth import requires_auth
+from eve.methods.common import parse, resolve_document_etag
+from eve.methods.patch import resolve_nested_documents
+from eve.versioning import (resolve_document_version, insert_versioning_documents,
+                            late_versioning_catch)
 from flask import jsonify, make_response, abort, request
+from pymongo import ReplaceOne, DeleteOne
+from werkzeug.exceptions import HTTPException
 
 from atlas import callbacks
 from atlas import commands
 from atlas import tasks
 from atlas import utilities
 from atlas.config import (ATLAS_LOCATION, VERSION_NUMBER, SSL_KEY_FILE, SSL_CRT_FILE, LOG_LOCATION,
-                          ENVIRONMENT, API_URLS)
+                          ENVIRONMENT, API_URLS, BULK_RESOURCES, AGGREGATION_CACHE_TTL,
+                          PERMISSIONS_BATCH_SIZE)
 
 
 if ATLAS_LOCATION not in sys.path:
@@ -104,12 +115,17 @@ def get_command(machine_name):
             instances = utilities.get_eve('sites')
             tasks.instance_heal.delay(instances)
         elif command == 'sync_instances':
-            tasks.instance_sync.delay()
+            tasks.instance_sync.delay(full=True)
         elif command == 'correct_file_permissions':
-            instances = utilities.get_eve('sites')
-            for instance in instances['_items']:
-                tasks.correct_file_permissions.delay(instance)
-                continue
+            # Hand out instances in batches, each task walks its batch in parallel.
+            batch = []
+            for instance in utilities.iter_eve('sites', projection=['sid']):
+                batch.append(instance)
+                if len(batch) == PERMISSIONS_BATCH_SIZE:
+                    tasks.correct_file_permissions_bulk.delay(batch)
+                    batch = []
+            if batch:
+                tasks.correct_file_permissions_bulk.delay(batch)
         elif command == 'backup_all_instances':
             tasks.backup_instances_all.delay(backup_type='on_demand')
         elif command == 'remove_extra_backups':
@@ -161,7 +177,7 @@ def import_backup():
     local_path_instance_record = False
     if remote_site_record['path'] != remote_site_record['sid']:
         query_string = 'where={{"path":"{0}"}}'.format(remote_site_record['path'])
-        local_path_instance_records = utilities.get_eve('sites', query_string)
+        local_path_instance_records = utilities.get_eve('sites', query_string, projection=['_id'])
         app.logger.info('Backup | Import | Local path instance record - %s',
                         local_path_instance_records)
         if local_path_instance_records['_meta']['total'] == 1:
@@ -239,6 +255,67 @@ def create_backup(site_id):
     return response
 
 
+# Last result of the sites aggregation, so that dashboards polling the endpoint don't rerun the
+# pipeline on every request.
+SITES_AGGREGATION_CACHE = {'expires': 0, 'result': None}
+
+
+def code_labels(code_ids):
+    """
+    Get a readable 'name-version' label for each code item.
+
+    :param code_ids: list of code ObjectIds
+    :return: dict of ObjectId to label
+    """
+    code_collection = app.data.driver.db[app.config['DOMAIN']['code']['datasource']['source']]
+    labels = {}
+    for code in code_collection.find({'_id': {'$in': code_ids}},
+                                     {'meta.name': 1, 'meta.version': 1}):
+        labels[code['_id']] = '{0}-{1}'.format(code['meta']['name'], code['meta']['version'])
+    return labels
+
+
+def aggregate_sites():
+    """
+    Count sites by status, update group, core, and profile with one MongoDB aggregation.
+
+    The pipeline groups on all four fields together, so the result is at most a few hundred rows
+    that we fold into the separate counts here.
+    """
+    sites_collection = app.data.driver.db[app.config['DOMAIN']['sites']['datasource']['source']]
+    pipeline = [
+        {'$match': {app.config['DELETED']: {'$ne': True}}},
+        {'$group': {
+            '_id': {
+                'status': '$status',
+                'update_group': '$update_group',
+                'core': '$code.core',
+                'profile': '$code.profile',
+            },
+            'count': {'$sum': 1},
+        }},
+    ]
+    rows = list(sites_collection.aggregate(pipeline))
+    labels = code_labels(list(set(
+        row['_id'][code_type] for row in rows for code_type in ['core', 'profile']
+        if row['_id'].get(code_type))))
+
+    total = 0
+    groupings = dict((field, Counter()) for field in ['status', 'update_group', 'core', 'profile'])
+    for row in rows:
+        total += row['count']
+        for field in ['status', 'update_group']:
+            groupings[field][row['_id'].get(field)] += row['count']
+        for code_type in ['core', 'profile']:
+            code_id = row['_id'].get(code_type)
+            if code_id:
+                groupings[code_type][labels.get(code_id, str(code_id))] += row['count']
+
+    agg = {'express': dict((field, dict(counts)) for field, counts in groupings.items())}
+    agg['express']['status']['total'] = total
+    return agg
+
+
 @app.route('/sites/aggregation', methods=['GET'])
 @app.route('/sites/agg', methods=['GET'])
 @requires_auth('sites')
@@ -247,25 +324,13 @@ def sites_statistics():
     Give some basic aggregations about site objects
     """
     app.logger.debug('Sites | Aggregations')
-    express_result = utilities.get_eve('sites')
-    app.logger.debug('Sites | Aggregations | Express Result - %s', express_result)
-    # Express sites
-    express_sites = express_result['_items']
-    agg = {}
-    count = Counter()
-    group = Counter()
-    # Total by state
-    for site in express_sites:
-        count[site['status']] += 1
-        group[site['update_group']] += 1
-    agg['express'] = {
-        'status': dict(count),
-        'update_group': dict(group)
-    }
-    # Total
-    agg['express']['status']['total'] = express_result['_meta']['total']
-
-    response = make_response(jsonify(agg))
+    if SITES_AGGREGATION_CACHE['expires'] < time.time():
+        SITES_AGGREGATION_CACHE['result'] = aggregate_sites()
+        SITES_AGGREGATION_CACHE['expires'] = time.time() + AGGREGATION_CACHE_TTL
+    else:
+        app.logger.debug('Sites | Aggregations | Serving cached result')
+
+    response = make_response(jsonify(SITES_AGGREGATION_CACHE['result']))
     return response
 
 
@@ -296,6 +361,180 @@ def execute_drush(drush_id):
     return response
 
 
+def bulk_item_error(item_id, code, message):
+    """
+    Result for a bulk item that was not written.
+    """
+    return {'_id': item_id, '_status': 'ERR', '_error': {'code': code, 'message': message}}
+
+
+def bulk_result_key(item_id):
+    """
+    Key for the result of a bulk item, the same for any spelling of an ObjectId.
+    """
+    try:
+        return str(ObjectId(item_id))
+    except (TypeError, InvalidId):
+        return str(item_id)
+
+
+@app.route('/bulk/<string:resource>', methods=['PATCH', 'DELETE'])
+@requires_auth('bulk')
+def bulk_write(resource):
+    """
+    Apply many PATCHes or DELETEs to a resource with a single MongoDB bulk write.
+
+    The body is a list of {"_id": ..., "_etag": ..., "updates": {...}} for PATCH, or
+    {"_id": ..., "_etag": ...} for DELETE. Every item needs the `_etag` it was read with. Each PATCH
+    item goes through the `on_pre_PATCH` hooks and validation, and items keep Eve's versioning and
+    soft delete behavior. Database callbacks fire once per batch through the `on_bulk_update`,
+    `on_bulk_updated`, `on_bulk_delete`, and `on_bulk_deleted` events (plus the `_<resource>`
+    variants) instead of once per item.
+
+    :param resource: resource to write to
+    """
+    if resource not in BULK_RESOURCES.get(request.method, []):
+        abort(409, 'Error: {0} does not support bulk {1}.'.format(resource, request.method))
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(409, 'Error: Send a list of items.')
+    app.logger.debug('Bulk | %s | %s | Items - %s', request.method, resource, items)
+
+    resource_def = app.config['DOMAIN'][resource]
+    collection = app.data.driver.db[resource_def['datasource']['source']]
+    etag_field = app.config['ETAG']
+    deleted_field = app.config['DELETED']
+    updated_field = app.config['LAST_UPDATED']
+    now = datetime.utcnow().replace(microsecond=0)
+
+    results = {}
+    requested = []
+    for item in items:
+        item_id = item.get('_id') if isinstance(item, dict) else None
+        try:
+            requested.append((ObjectId(item_id), item))
+        except (TypeError, InvalidId):
+            results[bulk_result_key(item_id)] = bulk_item_error(item_id, 404, 'Invalid _id')
+    originals = dict((document['_id'], document) for document in collection.find(
+        {'_id': {'$in': [object_id for object_id, item in requested]},
+         deleted_field: {'$ne': True}}))
+
+    # Check that every item exists, is unchanged since it was read, and is valid.
+    accepted = []
+    for object_id, item in requested:
+        original = originals.get(object_id)
+        if not original:
+            results[str(object_id)] = bulk_item_error(item['_id'], 404, 'Item not found')
+        elif not item.get('_etag'):
+            results[str(object_id)] = bulk_item_error(item['_id'], 428, 'Missing _etag')
+        elif item['_etag'] != original.get(etag_field):
+            results[str(object_id)] = bulk_item_error(item['_id'], 412, 'Item has changed')
+        elif request.method == 'PATCH':
+            payload = item.get('updates', {})
+            # Give the pre PATCH hooks a request for this item alone, like a single PATCH.
+            item_request = app.request_class.from_values(
+                method='PATCH', content_type='application/json', data=json.dumps(payload))
+            lookup = {'_id': str(object_id)}
+            try:
+                getattr(app, 'on_pre_PATCH')(resource, item_request, lookup)
+                getattr(app, 'on_pre_PATCH_' + resource)(item_request, lookup)
+            except HTTPException as error:
+                results[str(object_id)] = bulk_item_error(item['_id'], error.code,
+                                                          error.description)
+                continue
+            updates = parse(payload, resource)
+            validator = app.validator(resource_def['schema'], resource=resource)
+            if not validator.validate_update(updates, object_id, original):
+                results[str(object_id)] = bulk_item_error(item['_id'], 422, validator.errors)
+                continue
+            # Same steps and order as Eve's patch_internal.
+            updates = validator.document
+            late_versioning_catch(original, resource)
+            resolve_document_version(updates, resource, 'PATCH', original)
+            updates[updated_field] = now
+            if resource_def['soft_delete']:
+                updates[deleted_field] = False
+            accepted.append((updates, original))
+        else:
+            accepted.append((None, original))
+
+    # Python 2 comprehensions leak their variables, keep them apart from `updates` and `original`.
+    updates_list = [item_updates for item_updates, item_original in accepted]
+    original_list = [item_original for item_updates, item_original in accepted]
+    if request.method == 'PATCH':
+        getattr(app, 'on_bulk_update')(resource, updates_list, original_list)
+        getattr(app, 'on_bulk_update_' + resource)(updates_list, original_list)
+    else:
+        getattr(app, 'on_bulk_delete')(resource, original_list)
+        getattr(app, 'on_bulk_delete_' + resource)(original_list)
+
+    # Build the new documents and write them, only if nobody changed them in the meantime.
+    operations = []
+    documents = []
+    for updates, original in accepted:
+        match = {'_id': original['_id'], etag_field: original[etag_field]}
+        if request.method == 'DELETE' and not resource_def['soft_delete']:
+            operations.append(DeleteOne(match))
+            documents.append(None)
+            continue
+        document = deepcopy(original)
+        if request.method == 'PATCH':
+            document.update(resolve_nested_documents(updates, document))
+            resolve_document_etag(document, resource)
+        else:
+            # Same order as Eve's deleteitem_internal.
+            document[deleted_field] = True
+            document[updated_field] = now
+            resolve_document_etag(document, resource)
+            resolve_document_version(document, resource, 'DELETE', original)
+        operations.append(ReplaceOne(match, document))
+        documents.append(document)
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+    # Compare etags to find the writes that matched.
+    current = dict((document['_id'], document[etag_field]) for document in collection.find(
+        {'_id': {'$in': [original['_id'] for original in original_list]}}, {etag_field: 1}))
+    written = []
+    for (updates, original), document in zip(accepted, documents):
+        if document is None and original['_id'] not in current:
+            results[str(original['_id'])] = {'_id': str(original['_id']), '_status': 'OK'}
+            written.append((updates, original, document))
+        elif document is not None and current.get(original['_id']) == document[etag_field]:
+            results[str(original['_id'])] = {'_id': str(original['_id']), '_status': 'OK',
+                                             '_etag': document[etag_field]}
+            written.append((updates, original, document))
+        else:
+            results[str(original['_id'])] = bulk_item_error(
+                str(original['_id']), 412, 'Item has changed')
+    versions = [item_document for item_updates, item_original, item_document in written
+                if item_document]
+    if request.method == 'DELETE':
+        # Create previous versions if they weren't already there.
+        for updates, original, document in written:
+            if document:
+                late_versioning_catch(original, resource)
+    if versions:
+        insert_versioning_documents(resource, versions)
+
+    updates_list = [item_updates for item_updates, item_original, item_document in written]
+    original_list = [item_original for item_updates, item_original, item_document in written]
+    if request.method == 'PATCH':
+        getattr(app, 'on_bulk_updated')(resource, updates_list, original_list)
+        getattr(app, 'on_bulk_updated_' + resource)(updates_list, original_list)
+    else:
+        getattr(app, 'on_bulk_deleted')(resource, original_list)
+        getattr(app, 'on_bulk_deleted_' + resource)(original_list)
+
+    ordered_results = [
+        results[bulk_result_key(item.get('_id') if isinstance(item, dict) else None)]
+        for item in items]
+    app.logger.info('Bulk | %s | %s | Items - %s | Written - %s',
+                    request.method, resource, len(items), len(written))
+    status = 'OK' if len(written) == len(items) else 'ERR'
+    return jsonify({'_status': status, '_items': ordered_results})
+
+
 # Specific callbacks.
 # Use pre event hooks if there is a chance you want to abort.
 # Use DB hooks if you want to modify data on the way in.
@@ -321,6 +560,15 @@ app.on_replace += callbacks.pre_replace
 app.on_delete_item += callbacks.on_delete_item
 app.on_deleted_sites += callbacks.on_deleted_item_sites
 app.on_delete_item_backup += callbacks.on_delete_item_backup
+# Bulk event hooks, fired once per batch by the bulk endpoint.
+app.on_bulk_update += callbacks.on_bulk_update
+app.on_bulk_update_code += callbacks.on_bulk_update_code
+app.on_bulk_update_sites += callbacks.on_bulk_update_sites
+app.on_bulk_updated_code += callbacks.on_bulk_updated_code
+app.on_bulk_delete += callbacks.on_bulk_delete
+app.on_bulk_delete_sites += callbacks.on_bulk_delete_sites
+app.on_bulk_deleted_sites += callbacks.on_bulk_deleted_sites
+app.on_bulk_deleted_backup += callbacks.on_bulk_deleted_backup
 
 
 @app.errorhandler(409)